@@ -0,0 +1,11 @@
+# flake8: noqa
+import importlib
+
+# GFPGANer is imported on first access, so that importing a sub-package (e.g., gfpgan.archs) stays light
+__all__ = ['GFPGANer']
+
+
+def __getattr__(name):
+    if name == 'GFPGANer':
+        return importlib.import_module('gfpgan.utils').GFPGANer
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
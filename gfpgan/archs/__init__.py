@@ -1,10 +1,9 @@
-import importlib
-from basicsr.utils import scandir
+from basicsr.utils.registry import ARCH_REGISTRY
 from os import path as osp
 
-# automatically scan and import arch modules for registry
+from gfpgan.registry import register_lazy_modules
+
 # scan all the files that end with '_arch.py' under the archs folder
+# the arch modules are imported on the first ARCH_REGISTRY lookup of one of their archs
 arch_folder = osp.dirname(osp.abspath(__file__))
-arch_filenames = [osp.splitext(osp.basename(v))[0] for v in scandir(arch_folder) if v.endswith('_arch.py')]
-# import all the arch modules
-_arch_modules = [importlib.import_module(f'gfpgan.archs.{file_name}') for file_name in arch_filenames]
+register_lazy_modules(ARCH_REGISTRY, 'ARCH_REGISTRY', 'gfpgan.archs', arch_folder, '_arch.py')
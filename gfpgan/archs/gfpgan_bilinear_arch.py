@@ -5,8 +5,9 @@ from basicsr.utils.registry import ARCH_REGISTRY
 from torch import nn
 
 from .gfpganv1_arch import ResUpBlock
+from .native_ops import sft_modulate
 from .stylegan2_bilinear_arch import (ConvLayer, EqualConv2d, EqualLinear, ResBlock, ScaledLeakyReLU,
-                                      StyleGAN2GeneratorBilinear)
+                                      StyleGAN2GeneratorBilinear, fuse_equalized_layers, unfuse_equalized_layers)
 
 
 class StyleGAN2GeneratorBilinearSFT(StyleGAN2GeneratorBilinear):
@@ -109,12 +110,7 @@ class StyleGAN2GeneratorBilinearSFT(StyleGAN2GeneratorBilinear):
             # the conditions may have fewer levels
             if i < len(conditions):
                 # SFT part to combine the conditions
-                if self.sft_half:  # only apply SFT to half of the channels
-                    out_same, out_sft = torch.split(out, int(out.size(1) // 2), dim=1)
-                    out_sft = out_sft * conditions[i - 1] + conditions[i]
-                    out = torch.cat([out_same, out_sft], dim=1)
-                else:  # apply SFT to all the channels
-                    out = out * conditions[i - 1] + conditions[i]
+                out = sft_modulate(out, conditions[i - 1], conditions[i], sft_half=self.sft_half)
 
             out = conv2(out, latent[:, i + 1], noise=noise2)
             skip = to_rgb(out, latent[:, i + 2], skip)  # feature back to the rgb space
@@ -261,6 +257,18 @@ class GFPGANBilinear(nn.Module):
                     ScaledLeakyReLU(0.2),
                     EqualConv2d(out_channels, sft_out_channels, 3, stride=1, padding=1, bias=True, bias_init_val=0)))
 
+    def switch_to_deploy(self):
+        """Fold the equalized learning rate scales of the whole network into its weights, for inference.
+
+        The EqualLinear / EqualConv2d layers become plain nn.Linear / nn.Conv2d, see
+        :func:`gfpgan.archs.stylegan2_bilinear_arch.fuse_equalized_layers`. Load the weights before switching.
+        """
+        fuse_equalized_layers(self)
+
+    def switch_to_train(self):
+        """Reverse :meth:`switch_to_deploy`, e.g., to resume training or save a checkpoint."""
+        unfuse_equalized_layers(self)
+
     def forward(self, x, return_latents=False, return_rgb=True, randomize_noise=True):
         """Forward function for GFPGANBilinear.
 
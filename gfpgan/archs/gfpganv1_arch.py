@@ -3,11 +3,12 @@ import random
 import torch
 from basicsr.archs.stylegan2_arch import (ConvLayer, EqualConv2d, EqualLinear, ResBlock, ScaledLeakyReLU,
                                           StyleGAN2Generator)
-from basicsr.ops.fused_act import FusedLeakyReLU
 from basicsr.utils.registry import ARCH_REGISTRY
 from torch import nn
 from torch.nn import functional as F
 
+from .native_ops import FusedLeakyReLU, patch_basicsr_stylegan2, sft_modulate
+
 
 class StyleGAN2GeneratorSFT(StyleGAN2Generator):
     """StyleGAN2 Generator with SFT modulation (Spatial Feature Transform).
@@ -33,6 +34,9 @@ class StyleGAN2GeneratorSFT(StyleGAN2Generator):
                  lr_mlp=0.01,
                  narrow=1,
                  sft_half=False):
+        # make the basicsr StyleGAN2 layers use the vectorized ops, when a module built with them is constructed
+        # rather than on import, see patch_basicsr_stylegan2
+        patch_basicsr_stylegan2()
         super(StyleGAN2GeneratorSFT, self).__init__(
             out_size,
             num_style_feat=num_style_feat,
@@ -110,12 +114,7 @@ class StyleGAN2GeneratorSFT(StyleGAN2Generator):
             # the conditions may have fewer levels
             if i < len(conditions):
                 # SFT part to combine the conditions
-                if self.sft_half:  # only apply SFT to half of the channels
-                    out_same, out_sft = torch.split(out, int(out.size(1) // 2), dim=1)
-                    out_sft = out_sft * conditions[i - 1] + conditions[i]
-                    out = torch.cat([out_same, out_sft], dim=1)
-                else:  # apply SFT to all the channels
-                    out = out * conditions[i - 1] + conditions[i]
+                out = sft_modulate(out, conditions[i - 1], conditions[i], sft_half=self.sft_half)
 
             out = conv2(out, latent[:, i + 1], noise=noise2)
             skip = to_rgb(out, latent[:, i + 2], skip)  # feature back to the rgb space
@@ -160,6 +159,7 @@ class ConvUpLayer(nn.Module):
         self.padding = padding
         # self.scale is used to scale the convolution weights, which is related to the common initializations.
         self.scale = 1 / math.sqrt(in_channels * kernel_size**2)
+        self.scale_folded = False  # see fold_scale
 
         self.weight = nn.Parameter(torch.randn(out_channels, in_channels, kernel_size, kernel_size))
 
@@ -183,7 +183,7 @@ class ConvUpLayer(nn.Module):
         # conv
         out = F.conv2d(
             out,
-            self.weight * self.scale,
+            self.weight if self.scale_folded else self.weight * self.scale,
             bias=self.bias,
             stride=self.stride,
             padding=self.padding,
@@ -193,6 +193,18 @@ class ConvUpLayer(nn.Module):
             out = self.activation(out)
         return out
 
+    def fold_scale(self):
+        """Fold self.scale into the weight, for inference. Reversed by unfold_scale."""
+        if not self.scale_folded:
+            self.weight.data.mul_(self.scale)
+            self.scale_folded = True
+
+    def unfold_scale(self):
+        """Take self.scale out of the weight again, for training."""
+        if self.scale_folded:
+            self.weight.data.div_(self.scale)
+            self.scale_folded = False
+
 
 class ResUpBlock(nn.Module):
     """Residual block with upsampling.
@@ -203,6 +215,7 @@ class ResUpBlock(nn.Module):
     """
 
     def __init__(self, in_channels, out_channels):
+        patch_basicsr_stylegan2()
         super(ResUpBlock, self).__init__()
 
         self.conv1 = ConvLayer(in_channels, in_channels, 3, bias=True, activate=True)
@@ -256,6 +269,7 @@ class GFPGANv1(nn.Module):
             narrow=1,
             sft_half=False):
 
+        patch_basicsr_stylegan2()
         super(GFPGANv1, self).__init__()
         self.input_is_latent = input_is_latent
         self.different_w = different_w
@@ -407,6 +421,7 @@ class FacialComponentDiscriminator(nn.Module):
     """
 
     def __init__(self):
+        patch_basicsr_stylegan2()
         super(FacialComponentDiscriminator, self).__init__()
         # It now uses a VGG-style architectrue with fixed model size
         self.conv1 = ConvLayer(3, 64, 3, downsample=False, resample_kernel=(1, 3, 3, 1), bias=True, activate=True)
@@ -5,6 +5,7 @@ from basicsr.utils.registry import ARCH_REGISTRY
 from torch import nn
 from torch.nn import functional as F
 
+from .native_ops import sft_modulate
 from .stylegan2_clean_arch import StyleGAN2GeneratorClean
 
 
@@ -40,12 +41,14 @@ class StyleGAN2GeneratorCSFT(StyleGAN2GeneratorClean):
                 truncation=1,
                 truncation_latent=None,
                 inject_index=None,
-                return_latents=False):
+                return_latents=False,
+                decode_size=None):
         """Forward function for StyleGAN2GeneratorCSFT.
 
         Args:
             styles (list[Tensor]): Sample codes of styles.
-            conditions (list[Tensor]): SFT conditions to generators.
+            conditions (list[Tensor] | iterator): SFT conditions to generators: [scale_0, shift_0, scale_1, ...], or an
+                iterator of the (scale, shift) of each level, so that each level is computed just before it is used.
             input_is_latent (bool): Whether input is latent style. Default: False.
             noise (Tensor | None): Input noise or None. Default: None.
             randomize_noise (bool): Randomize noise, used when 'noise' is False. Default: True.
@@ -53,6 +56,8 @@ class StyleGAN2GeneratorCSFT(StyleGAN2GeneratorClean):
             truncation_latent (Tensor | None): The truncation latent tensor. Default: None.
             inject_index (int | None): The injection index for mixing noise. Default: None.
             return_latents (bool): Whether to return style latents. Default: False.
+            decode_size (int | None): Stop the generation once the image reaches this resolution (a power of 2), and
+                return the smaller image. The conditions of the skipped levels are not used. Default: None.
         """
         # style codes -> latents with Style MLP layer
         if not input_is_latent:
@@ -85,6 +90,10 @@ class StyleGAN2GeneratorCSFT(StyleGAN2GeneratorClean):
             latent2 = styles[1].unsqueeze(1).repeat(1, self.num_latent - inject_index, 1)
             latent = torch.cat([latent1, latent2], 1)
 
+        if isinstance(conditions, (list, tuple)):
+            conditions = zip(conditions[::2], conditions[1::2])  # (scale, shift) of each level
+        conditions = iter(conditions)
+
         # main generation
         out = self.constant_input(latent.shape[0])
         out = self.style_conv1(out, latent[:, 0], noise=noise[0])
@@ -93,17 +102,15 @@ class StyleGAN2GeneratorCSFT(StyleGAN2GeneratorClean):
         i = 1
         for conv1, conv2, noise1, noise2, to_rgb in zip(self.style_convs[::2], self.style_convs[1::2], noise[1::2],
                                                         noise[2::2], self.to_rgbs):
+            if decode_size is not None and skip.size(3) >= decode_size:
+                break  # early exit
             out = conv1(out, latent[:, i], noise=noise1)
 
             # the conditions may have fewer levels
-            if i < len(conditions):
+            condition = next(conditions, None)
+            if condition is not None:
                 # SFT part to combine the conditions
-                if self.sft_half:  # only apply SFT to half of the channels
-                    out_same, out_sft = torch.split(out, int(out.size(1) // 2), dim=1)
-                    out_sft = out_sft * conditions[i - 1] + conditions[i]
-                    out = torch.cat([out_same, out_sft], dim=1)
-                else:  # apply SFT to all the channels
-                    out = out * conditions[i - 1] + conditions[i]
+                out = sft_modulate(out, *condition, sft_half=self.sft_half)
 
             out = conv2(out, latent[:, i + 1], noise=noise2)
             skip = to_rgb(out, latent[:, i + 2], skip)  # feature back to the rgb space
@@ -273,17 +280,24 @@ class GFPGANv1Clean(nn.Module):
                 nn.Sequential(
                     nn.Conv2d(out_channels, out_channels, 3, 1, 1), nn.LeakyReLU(0.2, True),
                     nn.Conv2d(out_channels, sft_out_channels, 3, 1, 1)))
+        # the merged condition branches of the deploy mode, see switch_to_deploy
+        self.condition_fused = None
 
-    def forward(self, x, return_latents=False, return_rgb=True, randomize_noise=True, **kwargs):
+    def forward(self, x, return_latents=False, return_rgb=True, randomize_noise=True, decode_size=None, **kwargs):
         """Forward function for GFPGANv1Clean.
 
+        In inference (eval mode, without autograd), the SFT conditions of each level are computed just before the
+        StyleGAN2 decoder uses them, and each unet skip is freed once it is used, see :meth:`iter_conditions`. It
+        computes the same output with a lower peak memory.
+
         Args:
             x (Tensor): Input images.
             return_latents (bool): Whether to return style latents. Default: False.
             return_rgb (bool): Whether return intermediate rgb images. Default: True.
             randomize_noise (bool): Randomize noise, used when 'noise' is False. Default: True.
+            decode_size (int | None): Stop the StyleGAN2 decoder at this resolution, e.g., for small faces, the output
+                image has this size. In inference, the conditions of the skipped levels are not computed. Default: None.
         """
-        conditions = []
         unet_skips = []
         out_rgbs = []
 
@@ -291,7 +305,7 @@ class GFPGANv1Clean(nn.Module):
         feat = F.leaky_relu_(self.conv_body_first(x), negative_slope=0.2)
         for i in range(self.log_size - 2):
             feat = self.conv_body_down[i](feat)
-            unet_skips.insert(0, feat)
+            unet_skips.append(feat)
         feat = F.leaky_relu_(self.final_conv(feat), negative_slope=0.2)
 
         # style code
@@ -300,25 +314,125 @@ class GFPGANv1Clean(nn.Module):
             style_code = style_code.view(style_code.size(0), -1, self.num_style_feat)
 
         # decode
-        for i in range(self.log_size - 2):
-            # add unet skip
-            feat = feat + unet_skips[i]
-            # ResUpLayer
-            feat = self.conv_body_up[i](feat)
-            # generate scale and shift for SFT layers
-            scale = self.condition_scale[i](feat)
-            conditions.append(scale.clone())
-            shift = self.condition_shift[i](feat)
-            conditions.append(shift.clone())
-            # generate rgb images
-            if return_rgb:
-                out_rgbs.append(self.toRGB[i](feat))
+        if not self.training and not torch.is_grad_enabled():
+            conditions = self.iter_conditions(feat, unet_skips, out_rgbs if return_rgb else None)
+        else:
+            conditions = []
+            for i in range(self.log_size - 2):
+                # add unet skip
+                feat = feat + unet_skips.pop()
+                # ResUpLayer
+                feat = self.conv_body_up[i](feat)
+                # generate scale and shift for SFT layers
+                scale, shift = self.get_conditions(i, feat)
+                conditions.append(scale.clone())
+                conditions.append(shift.clone())
+                # generate rgb images
+                if return_rgb:
+                    out_rgbs.append(self.toRGB[i](feat))
 
         # decoder
         image, _ = self.stylegan_decoder([style_code],
                                          conditions,
                                          return_latents=return_latents,
                                          input_is_latent=self.input_is_latent,
-                                         randomize_noise=randomize_noise)
+                                         randomize_noise=randomize_noise,
+                                         decode_size=decode_size)
 
         return image, out_rgbs
+
+    def iter_conditions(self, feat, unet_skips, out_rgbs=None):
+        """Generate the SFT conditions (scale, shift) of each level, for inference.
+
+        Each level is computed when the decoder asks for it: only the features of the current level are alive, and
+        the unet skips are popped (and freed) as they are used. No copies of the conditions are made.
+
+        Args:
+            feat (Tensor): The output of the encoder.
+            unet_skips (list[Tensor]): The unet skips, from the highest to the lowest resolution. It is emptied.
+            out_rgbs (list | None): If not None, the intermediate rgb images are appended to it. Default: None.
+        """
+        for i in range(self.log_size - 2):
+            # add unet skip, ResUpLayer
+            feat = self.conv_body_up[i](feat + unet_skips.pop())
+            if out_rgbs is not None:
+                out_rgbs.append(self.toRGB[i](feat))
+            yield self.get_conditions(i, feat)
+
+    def get_conditions(self, level, feat):
+        """Compute the SFT conditions (scale, shift) of a level from its features."""
+        if self.condition_fused is not None:
+            return self.condition_fused[level](feat).chunk(2, dim=1)
+        return self.condition_scale[level](feat), self.condition_shift[level](feat)
+
+    def switch_to_deploy(self):
+        """Merge the scale and shift branches of each level into one branch, for inference.
+
+        Both branches (conv, lrelu, conv) run on the same features: their first convs become one conv with twice the
+        outputs, and their second convs one grouped conv (groups=2), whose outputs are the scale and the shift. The
+        outputs are the same, with one branch per level instead of two.
+
+        The state dict layout changes: checkpoints are loaded before, and :meth:`switch_to_train` restores the
+        original layout, e.g., to resume training or save a checkpoint.
+        """
+        if self.condition_fused is not None:
+            return
+        self.condition_fused = nn.ModuleList()
+        for scale_branch, shift_branch in zip(self.condition_scale, self.condition_shift):
+            self.condition_fused.append(
+                nn.Sequential(
+                    _merge_convs(scale_branch[0], shift_branch[0], groups=1), nn.LeakyReLU(0.2, True),
+                    _merge_convs(scale_branch[2], shift_branch[2], groups=2)))
+        del self.condition_scale, self.condition_shift
+
+    def switch_to_train(self):
+        """Reverse :meth:`switch_to_deploy`."""
+        if self.condition_fused is None:
+            return
+        self.condition_scale = nn.ModuleList()
+        self.condition_shift = nn.ModuleList()
+        for fused_branch in self.condition_fused:
+            first_convs = _split_conv(fused_branch[0], groups=1)
+            second_convs = _split_conv(fused_branch[2], groups=2)
+            self.condition_scale.append(nn.Sequential(first_convs[0], nn.LeakyReLU(0.2, True), second_convs[0]))
+            self.condition_shift.append(nn.Sequential(first_convs[1], nn.LeakyReLU(0.2, True), second_convs[1]))
+        self.condition_fused = None
+
+
+def _merge_convs(conv_a, conv_b, groups):
+    """Merge two convolutions into one whose outputs are the outputs of both.
+
+    With groups=1, both run on the same input. With groups=2, they run on the two halves of the input channels.
+    """
+    weight = conv_a.weight
+    conv = nn.Conv2d(
+        conv_a.in_channels * groups,
+        conv_a.out_channels * 2,
+        conv_a.kernel_size,
+        conv_a.stride,
+        conv_a.padding,
+        groups=groups,
+        device=weight.device,
+        dtype=weight.dtype)
+    conv.weight = nn.Parameter(torch.cat([conv_a.weight.detach(), conv_b.weight.detach()]), weight.requires_grad)
+    conv.bias = nn.Parameter(torch.cat([conv_a.bias.detach(), conv_b.bias.detach()]), weight.requires_grad)
+    return conv
+
+
+def _split_conv(conv, groups):
+    """Reverse :func:`_merge_convs`, return the two convolutions."""
+    weight = conv.weight
+    convs = []
+    for half_weight, half_bias in zip(weight.detach().chunk(2), conv.bias.detach().chunk(2)):
+        half_conv = nn.Conv2d(
+            conv.in_channels // groups,
+            conv.out_channels // 2,
+            conv.kernel_size,
+            conv.stride,
+            conv.padding,
+            device=weight.device,
+            dtype=weight.dtype)
+        half_conv.weight = nn.Parameter(half_weight.clone(), weight.requires_grad)
+        half_conv.bias = nn.Parameter(half_bias.clone(), weight.requires_grad)
+        convs.append(half_conv)
+    return convs
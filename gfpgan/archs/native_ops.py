@@ -0,0 +1,169 @@
+"""Pure PyTorch implementations of the StyleGAN2 custom ops of basicsr (fused_act and upfirdn2d).
+
+The basicsr ops need a compiled CUDA extension. These implementations are vectorized for CPU (and any device), and
+dispatch to the basicsr extension for CUDA tensors when it is available. It also has the SFT modulation shared by
+the GFPGAN architectures.
+"""
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+try:
+    from basicsr.ops.fused_act import fused_act_ext  # noqa: F401
+    from basicsr.ops.fused_act import fused_leaky_relu as _cuda_fused_leaky_relu
+except ImportError:
+    _cuda_fused_leaky_relu = None
+try:
+    from basicsr.ops.upfirdn2d import upfirdn2d_ext  # noqa: F401
+    from basicsr.ops.upfirdn2d import upfirdn2d as _cuda_upfirdn2d
+except ImportError:
+    _cuda_upfirdn2d = None
+
+
+def is_compiling():
+    """Whether the code runs under dynamo, i.e., torch.compile or torch.export (the default ONNX exporter).
+
+    Dynamo does not support some eager-only paths: data pointers, and out= ops on non-contiguous tensors.
+    """
+    if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'is_compiling'):  # PyTorch >= 2.3
+        return torch.compiler.is_compiling()
+    if hasattr(torch, '_dynamo') and hasattr(torch._dynamo, 'is_compiling'):
+        return torch._dynamo.is_compiling()
+    return False
+
+
+def fused_leaky_relu(input, bias=None, negative_slope=0.2, scale=2**0.5):
+    """Bias + leaky ReLU + gain: leaky_relu(input + bias) * scale.
+
+    Without autograd, the activation and the gain are applied in place on the biased tensor, so only one tensor is
+    allocated.
+
+    Args:
+        input (Tensor): Tensor with shape (b, c, ...).
+        bias (Tensor | None): Bias with shape (c, ). Default: None.
+        negative_slope (float): Negative slope of the leaky ReLU. Default: 0.2.
+        scale (float): The gain. Default: sqrt(2).
+
+    Returns:
+        Tensor: Output tensor.
+    """
+    if input.is_cuda and bias is not None and _cuda_fused_leaky_relu is not None:
+        return _cuda_fused_leaky_relu(input, bias, negative_slope, scale)
+    if bias is not None:
+        out = input + bias.view(1, -1, *([1] * (input.ndim - 2)))
+    elif torch.is_grad_enabled():
+        out = input
+    else:
+        out = input.clone()
+    if torch.is_grad_enabled():
+        return F.leaky_relu(out, negative_slope=negative_slope) * scale
+    return F.leaky_relu_(out, negative_slope=negative_slope).mul_(scale)
+
+
+class FusedLeakyReLU(nn.Module):
+    """Drop-in replacement of basicsr FusedLeakyReLU, with the same parameters.
+
+    Args:
+        channel (int): Channel number of the bias.
+        negative_slope (float): Negative slope of the leaky ReLU. Default: 0.2.
+        scale (float): The gain. Default: sqrt(2).
+    """
+
+    def __init__(self, channel, negative_slope=0.2, scale=2**0.5):
+        super(FusedLeakyReLU, self).__init__()
+        self.bias = nn.Parameter(torch.zeros(channel))
+        self.negative_slope = negative_slope
+        self.scale = scale
+
+    def forward(self, input):
+        return fused_leaky_relu(input, self.bias, self.negative_slope, self.scale)
+
+
+def sft_modulate(out, scale, shift, sft_half=False):
+    """SFT modulation (Spatial Feature Transform): out * scale + shift.
+
+    Without autograd, it runs in place as one fused multiply-add, on the channel slice when sft_half, instead of
+    splitting the feature map and concatenating the halves into a new one. It is not in place while tracing, so that
+    the exported graphs only have out-of-place ops, nor while compiling: dynamo breaks the graph on out= ops with the
+    non-contiguous channel slice.
+
+    Args:
+        out (Tensor): Feature map with shape (b, c, h, w). Modified in place without autograd.
+        scale (Tensor): Scale with shape (b, c, h, w), or (b, c // 2, h, w) if sft_half.
+        shift (Tensor): Shift with the shape of scale.
+        sft_half (bool): Whether to only apply SFT to the second half of the channels. Default: False.
+
+    Returns:
+        Tensor: The modulated feature map.
+    """
+    if torch.is_grad_enabled() or torch.jit.is_tracing() or is_compiling():
+        if sft_half:  # only apply SFT to half of the channels
+            out_same, out_sft = torch.split(out, int(out.size(1) // 2), dim=1)
+            return torch.cat([out_same, out_sft * scale + shift], dim=1)
+        return out * scale + shift
+    out_sft = out[:, out.size(1) // 2:] if sft_half else out
+    torch.addcmul(shift, out_sft, scale, out=out_sft)
+    return out
+
+
+def _separate_kernel(kernel):
+    """Split a 2D kernel into its column and row 1D kernels, or return None if it is not separable."""
+    total = kernel.sum()
+    if total == 0:
+        return None
+    kernel_col = kernel.sum(1)
+    kernel_row = kernel.sum(0) / total
+    if not torch.allclose(torch.outer(kernel_col, kernel_row), kernel, rtol=1e-5, atol=1e-7):
+        return None
+    return kernel_col, kernel_row
+
+
+def upfirdn2d(input, kernel, up=1, down=1, pad=(0, 0)):
+    """Upsample by zero insertion, pad, apply a FIR filter and downsample, as basicsr upfirdn2d.
+
+    Instead of the reference implementation (one single-channel convolution over the whole upsampled image, then
+    dropping the pixels that are not sampled), the filter runs as a depthwise convolution whose stride does the
+    downsampling. The resampling kernels of StyleGAN2 are separable, they run as two 1D depthwise convolutions.
+
+    Args:
+        input (Tensor): Tensor with shape (b, c, h, w).
+        kernel (Tensor): FIR filter with shape (kh, kw).
+        up (int): Upsampling factor. Default: 1.
+        down (int): Downsampling factor. Default: 1.
+        pad (tuple[int]): Padding (before, after) of both spatial dimensions, negative values crop. Default: (0, 0).
+
+    Returns:
+        Tensor: Output tensor.
+    """
+    if input.is_cuda and _cuda_upfirdn2d is not None:
+        return _cuda_upfirdn2d(input, kernel, up=up, down=down, pad=pad)
+    b, c, h, w = input.shape
+    out = input
+    if up > 1:
+        out = input.new_zeros(b, c, h * up, w * up)
+        out[:, :, ::up, ::up] = input
+    out = F.pad(out, [pad[0], pad[1], pad[0], pad[1]])
+
+    # upfirdn2d is a correlation with the flipped kernel
+    kernel = torch.flip(kernel, [0, 1]).to(out)
+    kernels = _separate_kernel(kernel)
+    if kernels is None:
+        weight = kernel[None, None].repeat(c, 1, 1, 1)
+        return F.conv2d(out, weight, stride=down, groups=c)
+    kernel_col, kernel_row = kernels
+    out = F.conv2d(out, kernel_col.view(1, 1, -1, 1).repeat(c, 1, 1, 1), stride=(down, 1), groups=c)
+    return F.conv2d(out, kernel_row.view(1, 1, 1, -1).repeat(c, 1, 1, 1), stride=(1, down), groups=c)
+
+
+def patch_basicsr_stylegan2():
+    """Make the StyleGAN2 layers of basicsr (basicsr.archs.stylegan2_arch) use the ops of this file.
+
+    The layers built afterwards use :class:`FusedLeakyReLU`, and every layer uses :func:`fused_leaky_relu` and
+    :func:`upfirdn2d`, which dispatch to the basicsr CUDA extension for CUDA tensors when it is available. It is
+    idempotent. It changes basicsr for the whole process, so it is not applied on import: the gfpganv1_arch modules
+    built with basicsr layers apply it when they are constructed.
+    """
+    from basicsr.archs import stylegan2_arch
+    stylegan2_arch.FusedLeakyReLU = FusedLeakyReLU
+    stylegan2_arch.fused_leaky_relu = fused_leaky_relu
+    stylegan2_arch.upfirdn2d = upfirdn2d
@@ -5,6 +5,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .native_ops import is_compiling
+
+# F.scaled_dot_product_attention has fused CPU kernels from PyTorch 2.2 on, before that it runs the math kernel on CPU,
+# which materializes the whole attention matrix
+SDPA_FUSED_ON_CPU = tuple(int(v) for v in torch.__version__.split('.')[:2]) >= (2, 2)
+
 
 class VectorQuantizer(nn.Module):
     """
@@ -18,6 +24,9 @@ class VectorQuantizer(nn.Module):
     _____________________________________________
     """
 
+    # number of rows of the distance matrix computed at once by the inference path, caps its memory
+    distance_chunk_size = 4096
+
     def __init__(self, n_e, e_dim, beta):
         super(VectorQuantizer, self).__init__()
         self.n_e = n_e
@@ -26,6 +35,8 @@ class VectorQuantizer(nn.Module):
 
         self.embedding = nn.Embedding(self.n_e, self.e_dim)
         self.embedding.weight.data.uniform_(-1.0 / self.n_e, 1.0 / self.n_e)
+        # (key, fp32 codebook, squared norms of the codes), see get_codebook_fp32
+        self._codebook_cache = None
 
     def forward(self, z):
         """
@@ -36,15 +47,21 @@ class VectorQuantizer(nn.Module):
         quantization pipeline:
             1. get encoder input (B,C,H,W)
             2. flatten input to (B*H*W,C)
+        in inference (eval mode, without autograd), it runs forward_inference instead
         """
+        if not self.training and not torch.is_grad_enabled():
+            return self.forward_inference(z)
+
         # reshape z -> (batch, height, width, channel) and flatten
         z = z.permute(0, 2, 3, 1).contiguous()
         z_flattened = z.view(-1, self.e_dim)
         # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight**2, dim=1) - 2 * \
-            torch.matmul(z_flattened, self.embedding.weight.t())
+        # computed in fp32: in half precision the cancellation picks wrong codes
+        z_flattened_fp32 = z_flattened.float()
+        embedding_fp32 = self.embedding.weight.float()
+        d = torch.sum(z_flattened_fp32 ** 2, dim=1, keepdim=True) + \
+            torch.sum(embedding_fp32**2, dim=1) - 2 * \
+            torch.matmul(z_flattened_fp32, embedding_fp32.t())
 
         # could possible replace this here
         # #\start...
@@ -87,14 +104,51 @@ class VectorQuantizer(nn.Module):
 
         return z_q, loss, (perplexity, min_encodings, min_encoding_indices, d)
 
+    def forward_inference(self, z):
+        """The inference path of forward: the closest codes, without the loss, the perplexity and the one-hot encodings.
+
+        The closest codes are the argmin of e^2 - 2 e * z (z^2 does not change it), computed in fp32 over chunks of
+        distance_chunk_size rows, and the codes are gathered from the codebook.
+
+        Returns:
+            tuple: z_q, None in place of the loss, and (None, None, min_encoding_indices, None) in place of (perplexity,
+                min_encodings, min_encoding_indices, d).
+        """
+        b, _, h, w = z.shape
+        z_flattened = z.permute(0, 2, 3, 1).reshape(-1, self.e_dim)
+        embedding_fp32, embedding_norms = self.get_codebook_fp32()
+        # no chunks while tracing or compiling, the number of rows of the graphs is dynamic
+        if torch.jit.is_tracing() or is_compiling():
+            chunks = [z_flattened]
+        else:
+            chunks = z_flattened.split(self.distance_chunk_size)
+        min_encoding_indices = torch.cat([
+            torch.addmm(embedding_norms, chunk.float(), embedding_fp32.t(), alpha=-2).argmin(dim=1) for chunk in chunks
+        ])
+        z_q = self.embedding(min_encoding_indices).view(b, h, w, self.e_dim)
+        z_q = z_q.permute(0, 3, 1, 2).contiguous()
+        return z_q, None, (None, None, min_encoding_indices.unsqueeze(1), None)
+
+    def get_codebook_fp32(self):
+        """Return the codebook in fp32 and the squared norms of its codes, cached until the codebook changes.
+
+        The cache is keyed on the data pointer of the codebook, which dynamo cannot read: under torch.compile and
+        torch.export, they are computed in the graph instead.
+        """
+        weight = self.embedding.weight
+        if is_compiling():
+            embedding_fp32 = weight.detach().float()
+            return embedding_fp32, torch.sum(embedding_fp32**2, dim=1)
+        key = (weight.data_ptr(), weight._version, weight.dtype, weight.device)
+        if self._codebook_cache is None or self._codebook_cache[0] != key:
+            embedding_fp32 = weight.detach().float()
+            self._codebook_cache = (key, embedding_fp32, torch.sum(embedding_fp32**2, dim=1))
+        return self._codebook_cache[1:]
+
     def get_codebook_entry(self, indices, shape):
         # shape specifying (batch, height, width, channel)
-        # TODO: check for more easy handling with nn.Embedding
-        min_encodings = torch.zeros(indices.shape[0], self.n_e).to(indices)
-        min_encodings.scatter_(1, indices[:, None], 1)
-
-        # get quantized latent vectors
-        z_q = torch.matmul(min_encodings.float(), self.embedding.weight)
+        # get quantized latent vectors, gathered from the codebook
+        z_q = self.embedding(indices)
 
         if shape is not None:
             z_q = z_q.view(shape)
@@ -211,48 +265,95 @@ class MultiHeadAttnBlock(nn.Module):
         self.v = torch.nn.Conv2d(in_channels, in_channels, kernel_size=1, stride=1, padding=0)
         self.proj_out = torch.nn.Conv2d(in_channels, in_channels, kernel_size=1, stride=1, padding=0)
         self.num = 0
+        # the merged q, k and v projections of the deploy mode, see switch_to_deploy
+        self.qkv = None
 
     def forward(self, x, y=None):
         h_ = x
         h_ = self.norm1(h_)
-        if y is None:
-            y = h_
+        if self.qkv is not None:
+            c = self.in_channels
+            if y is None:
+                q, k, v = self.qkv(h_).split(c, dim=1)
+            else:
+                # the q and the (k, v) rows of the merged weight are views, nothing is copied
+                q = F.conv2d(self.norm2(y), self.qkv.weight[:c], self.qkv.bias[:c])
+                k, v = F.conv2d(h_, self.qkv.weight[c:], self.qkv.bias[c:]).split(c, dim=1)
+        elif y is None:
+            # self-attention: q, k and v in one projection
+            q, k, v = merged_conv1x1(h_, self.q, self.k, self.v)
         else:
-            y = self.norm2(y)
-
-        q = self.q(y)
-        k = self.k(h_)
-        v = self.v(h_)
+            q = self.q(self.norm2(y))
+            k, v = merged_conv1x1(h_, self.k, self.v)
 
         # compute attention
         b, c, h, w = q.shape
-        q = q.reshape(b, self.head_size, self.att_size, h * w)
-        q = q.permute(0, 3, 1, 2)  # b, hw, head, att
-
-        k = k.reshape(b, self.head_size, self.att_size, h * w)
-        k = k.permute(0, 3, 1, 2)
+        q, k, v = (t.reshape(b, self.head_size, self.att_size, h * w).transpose(2, 3) for t in (q, k, v))
+        w_ = scaled_dot_product_attention(q, k, v)  # b, head, hw, att
+        w_ = w_.transpose(2, 3).reshape(b, c, h, w)
 
-        v = v.reshape(b, self.head_size, self.att_size, h * w)
-        v = v.permute(0, 3, 1, 2)
+        w_ = self.proj_out(w_)
 
-        q = q.transpose(1, 2)
-        v = v.transpose(1, 2)
-        k = k.transpose(1, 2).transpose(2, 3)
+        return x + w_
 
-        scale = int(self.att_size)**(-0.5)
-        q.mul_(scale)
-        w_ = torch.matmul(q, k)
-        w_ = F.softmax(w_, dim=3)
+    def switch_to_deploy(self):
+        """Merge the q, k and v projections into one 1x1 conv, once, for inference.
 
-        w_ = w_.matmul(v)
+        Otherwise, their weights are concatenated in every forward pass, see :func:`merged_conv1x1`. The state dict
+        layout changes: checkpoints are loaded before, and :meth:`switch_to_train` restores the original layout.
+        """
+        if self.qkv is not None:
+            return
+        convs = (self.q, self.k, self.v)
+        weight = self.q.weight
+        self.qkv = nn.Conv2d(
+            self.in_channels, self.in_channels * 3, kernel_size=1, device=weight.device, dtype=weight.dtype)
+        self.qkv.weight = nn.Parameter(torch.cat([conv.weight.detach() for conv in convs]), weight.requires_grad)
+        self.qkv.bias = nn.Parameter(torch.cat([conv.bias.detach() for conv in convs]), weight.requires_grad)
+        del self.q, self.k, self.v
+
+    def switch_to_train(self):
+        """Reverse :meth:`switch_to_deploy`."""
+        if self.qkv is None:
+            return
+        weight = self.qkv.weight
+        for name, conv_weight, conv_bias in zip(('q', 'k', 'v'), weight.detach().chunk(3),
+                                                self.qkv.bias.detach().chunk(3)):
+            conv = nn.Conv2d(
+                self.in_channels, self.in_channels, kernel_size=1, device=weight.device, dtype=weight.dtype)
+            conv.weight = nn.Parameter(conv_weight.clone(), weight.requires_grad)
+            conv.bias = nn.Parameter(conv_bias.clone(), weight.requires_grad)
+            setattr(self, name, conv)
+        self.qkv = None
+
+
+def merged_conv1x1(x, *convs):
+    """Run 1x1 convolutions on the same input as one convolution, and return their outputs.
+
+    Their weights are concatenated in every call: for inference, :meth:`MultiHeadAttnBlock.switch_to_deploy` merges
+    them once.
+    """
+    weight = torch.cat([conv.weight for conv in convs])
+    bias = torch.cat([conv.bias for conv in convs])
+    return F.conv2d(x, weight, bias).split([conv.out_channels for conv in convs], dim=1)
 
-        w_ = w_.transpose(1, 2).contiguous()  # [b, h*w, head, att]
-        w_ = w_.view(b, h, w, -1)
-        w_ = w_.permute(0, 3, 1, 2)
 
-        w_ = self.proj_out(w_)
+def scaled_dot_product_attention(q, k, v, chunk_size=1024):
+    """Attention softmax(q k^T / sqrt(att)) v of tensors with shape (b, head, hw, att).
 
-        return x + w_
+    On CUDA (PyTorch >= 2.0) and on CPU (PyTorch >= 2.2), it runs the fused kernels of F.scaled_dot_product_attention,
+    which do not materialize the whole attention matrix. Otherwise, the queries are processed in chunks of chunk_size,
+    so that only (b, head, chunk_size, hw) attention weights are alive at once.
+    """
+    fused = q.is_cuda or (q.device.type == 'cpu' and SDPA_FUSED_ON_CPU)
+    if fused and hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(q, k, v)
+    scale = q.size(-1)**(-0.5)
+    k_t = k.transpose(2, 3)
+    outputs = []
+    for q_chunk in q.split(chunk_size, dim=2):
+        outputs.append(F.softmax(torch.matmul(q_chunk * scale, k_t), dim=3).matmul(v))
+    return torch.cat(outputs, dim=2)
 
 
 class MultiHeadEncoder(nn.Module):
@@ -321,14 +422,29 @@ class MultiHeadEncoder(nn.Module):
         self.conv_out = torch.nn.Conv2d(
             block_in, 2 * z_channels if double_z else z_channels, kernel_size=3, stride=1, padding=1)
 
-    def forward(self, x):
+    def forward(self, x, keep=None):
+        """Forward function.
+
+        Args:
+            x (Tensor): Input images.
+            keep (set[str] | None): The names of the intermediate features to return, the others are freed as soon as
+                they are used. Default: None, which returns all of them.
+
+        Returns:
+            dict[str, Tensor]: The intermediate features, and the output as 'out'.
+        """
         hs = {}
+
+        def store(name, feat):
+            if keep is None or name in keep:
+                hs[name] = feat
+
         # timestep embedding
         temb = None
 
         # downsampling
         h = self.conv_in(x)
-        hs['in'] = h
+        store('in', h)
         for i_level in range(self.num_resolutions):
             for i_block in range(self.num_res_blocks):
                 h = self.down[i_level].block[i_block](h, temb)
@@ -337,17 +453,17 @@ class MultiHeadEncoder(nn.Module):
 
             if i_level != self.num_resolutions - 1:
                 # hs.append(h)
-                hs['block_' + str(i_level)] = h
+                store('block_' + str(i_level), h)
                 h = self.down[i_level].downsample(h)
 
         # middle
         # h = hs[-1]
         if self.enable_mid:
             h = self.mid.block_1(h, temb)
-            hs['block_' + str(i_level) + '_atten'] = h
+            store('block_' + str(i_level) + '_atten', h)
             h = self.mid.attn_1(h)
             h = self.mid.block_2(h, temb)
-            hs['mid_atten'] = h
+            store('mid_atten', h)
 
         # end
         h = self.norm_out(h)
@@ -534,7 +650,19 @@ class MultiHeadDecoderTransformer(nn.Module):
         self.norm_out = Normalize(block_in)
         self.conv_out = torch.nn.Conv2d(block_in, out_ch, kernel_size=3, stride=1, padding=1)
 
+        # the names of the encoder features used by forward
+        self.skip_names = {'block_' + str(i_level) + '_atten' for i_level, up in enumerate(self.up) if len(up.attn) > 0}
+        if self.enable_mid:
+            self.skip_names.add('mid_atten')
+
     def forward(self, z, hs):
+        """Forward function.
+
+        Args:
+            z (Tensor): The quantized latent.
+            hs (dict[str, Tensor]): The encoder features, see skip_names. Each one is removed from hs after its last
+                use, so that it is freed as soon as possible.
+        """
         # assert z.shape[1:] == self.z_shape[1:]
         # self.last_z_shape = z.shape
 
@@ -547,16 +675,19 @@ class MultiHeadDecoderTransformer(nn.Module):
         # middle
         if self.enable_mid:
             h = self.mid.block_1(h, temb)
-            h = self.mid.attn_1(h, hs['mid_atten'])
+            h = self.mid.attn_1(h, hs.pop('mid_atten'))
             h = self.mid.block_2(h, temb)
 
         # upsampling
         for i_level in reversed(range(self.num_resolutions)):
+            if len(self.up[i_level].attn) > 0:
+                skip = hs.pop('block_' + str(i_level) + '_atten')
             for i_block in range(self.num_res_blocks + 1):
                 h = self.up[i_level].block[i_block](h, temb)
                 if len(self.up[i_level].attn) > 0:
-                    h = self.up[i_level].attn[i_block](h, hs['block_' + str(i_level) + '_atten'])
+                    h = self.up[i_level].attn[i_block](h, skip)
                     # hfeature = h.clone()
+            skip = None
             if i_level != 0:
                 h = self.up[i_level].upsample(h)
 
@@ -638,10 +769,25 @@ class RestoreFormer(nn.Module):
             for _, param in self.encoder.named_parameters():
                 param.requires_grad = False
 
-    def encode(self, x):
+    def switch_to_deploy(self):
+        """Merge the q, k and v projections of the attention blocks, for inference.
 
-        hs = self.encoder(x)
-        h = self.quant_conv(hs['out'])
+        See :meth:`MultiHeadAttnBlock.switch_to_deploy`. Load the weights before switching.
+        """
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttnBlock):
+                module.switch_to_deploy()
+
+    def switch_to_train(self):
+        """Reverse :meth:`switch_to_deploy`, e.g., to resume training or save a checkpoint."""
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttnBlock):
+                module.switch_to_train()
+
+    def encode(self, x, keep=None):
+        """Encode and quantize the images, keep is passed to the encoder."""
+        hs = self.encoder(x, keep=keep)
+        h = self.quant_conv(hs.pop('out'))
         quant, emb_loss, info = self.quantize(h)
         return quant, emb_loss, info, hs
 
@@ -652,7 +798,8 @@ class RestoreFormer(nn.Module):
         return dec
 
     def forward(self, input, **kwargs):
-        quant, diff, info, hs = self.encode(input)
+        # only keep the encoder features used by the decoder, which frees them after their last use
+        quant, diff, info, hs = self.encode(input, keep=self.decoder.skip_names)
         dec = self.decode(quant, hs)
 
         return dec, None
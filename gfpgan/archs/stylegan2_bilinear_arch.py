@@ -1,11 +1,12 @@
 import math
 import random
 import torch
-from basicsr.ops.fused_act import FusedLeakyReLU, fused_leaky_relu
 from basicsr.utils.registry import ARCH_REGISTRY
 from torch import nn
 from torch.nn import functional as F
 
+from .native_ops import FusedLeakyReLU, fused_leaky_relu
+
 
 class NormStyleCode(nn.Module):
 
@@ -74,6 +75,10 @@ class ModulatedConv2d(nn.Module):
 
     There is no bias in ModulatedConv2d.
 
+    The ``modulate_mode`` attribute selects how the style is applied: 'weight' (grouped convolution with a modulated
+    weight per sample), 'input' (modulated input, shared convolution, demodulated output) or 'auto' (default, 'input'
+    for batches of at least ``modulate_input_min_batch`` samples). See gfpgan/archs/stylegan2_clean_arch.py.
+
     Args:
         in_channels (int): Channel number of the input.
         out_channels (int): Channel number of the output.
@@ -87,6 +92,9 @@ class ModulatedConv2d(nn.Module):
             Default: 1e-8.
     """
 
+    # smallest batch size modulating the input in 'auto' modulate mode
+    modulate_input_min_batch = 4
+
     def __init__(self,
                  in_channels,
                  out_channels,
@@ -110,6 +118,8 @@ class ModulatedConv2d(nn.Module):
             self.align_corners = False
 
         self.scale = 1 / math.sqrt(in_channels * kernel_size**2)
+        self.scale_folded = False  # see fold_scale
+        self.modulate_mode = 'auto'
         # modulation inside each modulated conv
         self.modulation = EqualLinear(
             num_style_feat, in_channels, bias=True, bias_init_val=1, lr_mul=1, activation=None)
@@ -127,14 +137,22 @@ class ModulatedConv2d(nn.Module):
         Returns:
             Tensor: Modulated tensor after convolution.
         """
+        if self.modulate_mode == 'input' or (self.modulate_mode == 'auto'
+                                             and x.size(0) >= self.modulate_input_min_batch):
+            return self.forward_modulate_input(x, style)
+
         b, c, h, w = x.shape  # c = c_in
         # weight modulation
         style = self.modulation(style).view(b, 1, c, 1, 1)
         # self.weight: (1, c_out, c_in, k, k); style: (b, 1, c, 1, 1)
-        weight = self.scale * self.weight * style  # (b, c_out, c_in, k, k)
+        if self.scale_folded:
+            weight = self.weight * style  # (b, c_out, c_in, k, k)
+        else:
+            weight = self.scale * self.weight * style  # (b, c_out, c_in, k, k)
 
         if self.demodulate:
-            demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + self.eps)
+            # the sum of squares overflows / loses precision in half precision, demodulate in fp32
+            demod = torch.rsqrt(weight.float().pow(2).sum([2, 3, 4]) + self.eps).to(weight.dtype)
             weight = weight * demod.view(b, self.out_channels, 1, 1, 1)
 
         weight = weight.view(b * self.out_channels, c, self.kernel_size, self.kernel_size)
@@ -152,6 +170,36 @@ class ModulatedConv2d(nn.Module):
 
         return out
 
+    def forward_modulate_input(self, x, style):
+        """Forward function modulating the input instead of the weight, see the ``modulate_mode`` attribute."""
+        style = self.modulation(style)  # (b, c_in)
+        # the style scales each input channel, it commutes with the resampling
+        x = x * style.unsqueeze(-1).unsqueeze(-1)
+        if self.sample_mode == 'upsample':
+            x = F.interpolate(x, scale_factor=2, mode=self.interpolation_mode, align_corners=self.align_corners)
+        elif self.sample_mode == 'downsample':
+            x = F.interpolate(x, scale_factor=0.5, mode=self.interpolation_mode, align_corners=self.align_corners)
+
+        weight = self.weight[0] if self.scale_folded else self.scale * self.weight[0]  # (c_out, c_in, k, k)
+        out = F.conv2d(x, weight, padding=self.padding)
+        if self.demodulate:
+            # sum over (c_in, k, k) of (weight * style)^2 = style^2 @ (sum over (k, k) of weight^2), in fp32
+            demod = torch.rsqrt(torch.matmul(style.float().pow(2), weight.float().pow(2).sum([2, 3]).t()) + self.eps)
+            out = out * demod.to(out.dtype).unsqueeze(-1).unsqueeze(-1)
+        return out
+
+    def fold_scale(self):
+        """Fold the equalized learning rate scale into the weight, for inference. Reversed by unfold_scale."""
+        if not self.scale_folded:
+            self.weight.data.mul_(self.scale)
+            self.scale_folded = True
+
+    def unfold_scale(self):
+        """Take the equalized learning rate scale out of the weight again, for training."""
+        if self.scale_folded:
+            self.weight.data.div_(self.scale)
+            self.scale_folded = False
+
     def __repr__(self):
         return (f'{self.__class__.__name__}(in_channels={self.in_channels}, '
                 f'out_channels={self.out_channels}, '
@@ -385,6 +433,14 @@ class StyleGAN2GeneratorBilinear(nn.Module):
         latent = self.style_mlp(latent_in).mean(0, keepdim=True)
         return latent
 
+    def switch_to_deploy(self):
+        """Fold the equalized learning rate scales into the weights, see :func:`fuse_equalized_layers`."""
+        fuse_equalized_layers(self)
+
+    def switch_to_train(self):
+        """Reverse :meth:`switch_to_deploy`."""
+        unfuse_equalized_layers(self)
+
     def forward(self,
                 styles,
                 input_is_latent=False,
@@ -611,3 +667,93 @@ class ResBlock(nn.Module):
         skip = self.skip(x)
         out = (out + skip) / math.sqrt(2)
         return out
+
+
+def _equal_to_plain(layer):
+    """Make the plain nn.Linear / nn.Conv2d computing the same as an EqualLinear / EqualConv2d.
+
+    The scale, lr_mul and the bias multiplier are folded into the weight and bias. The fused leaky ReLU of an
+    EqualLinear (activation='fused_lrelu') is leaky_relu(x + b) * sqrt(2) = leaky_relu(sqrt(2) * x + sqrt(2) * b), so
+    sqrt(2) is also folded in and the activation becomes a plain nn.LeakyReLU.
+    """
+    gain = math.sqrt(2) if getattr(layer, 'activation', None) == 'fused_lrelu' else 1
+    has_bias = layer.bias is not None
+    weight = layer.weight.detach() * (layer.scale * gain)
+    if type(layer).__name__ == 'EqualLinear':
+        plain = nn.utils.skip_init(
+            nn.Linear, layer.in_channels, layer.out_channels, bias=has_bias, device=weight.device, dtype=weight.dtype)
+    else:
+        plain = nn.utils.skip_init(
+            nn.Conv2d,
+            layer.in_channels,
+            layer.out_channels,
+            layer.kernel_size,
+            stride=layer.stride,
+            padding=layer.padding,
+            bias=has_bias,
+            device=weight.device,
+            dtype=weight.dtype)
+    plain.weight = nn.Parameter(weight, requires_grad=layer.weight.requires_grad)
+    if has_bias:
+        bias = layer.bias.detach() * (getattr(layer, 'lr_mul', 1) * gain)
+        plain.bias = nn.Parameter(bias, requires_grad=layer.bias.requires_grad)
+    if gain != 1:
+        plain = nn.Sequential(plain, nn.LeakyReLU(negative_slope=0.2, inplace=True))
+    return plain
+
+
+def _plain_to_equal(plain, layer):
+    """Load the weights of a plain layer made by :func:`_equal_to_plain` back into its equalized layer."""
+    gain = math.sqrt(2) if getattr(layer, 'activation', None) == 'fused_lrelu' else 1
+    if isinstance(plain, nn.Sequential):
+        plain = plain[0]
+    layer.weight = nn.Parameter(
+        plain.weight.detach() / (layer.scale * gain), requires_grad=plain.weight.requires_grad)
+    if plain.bias is not None:
+        layer.bias = nn.Parameter(
+            plain.bias.detach() / (getattr(layer, 'lr_mul', 1) * gain), requires_grad=plain.bias.requires_grad)
+    return layer
+
+
+def fuse_equalized_layers(model):
+    """Fold the equalized learning rate scales of a StyleGAN2-like network into its weights, in place.
+
+    Every EqualLinear and EqualConv2d (of this file, or of basicsr) is replaced by a plain nn.Linear / nn.Conv2d, and
+    the modules with a ``fold_scale`` method (e.g., ModulatedConv2d) fold their scale into their weight. The forward
+    pass then no longer computes ``weight * scale`` for every layer. Load the weights before fusing: the names of
+    the fused parameters differ from the ones of the checkpoints.
+
+    The replaced layers are kept (without their weights) in ``model.fused_equalized_layers``, so that
+    :func:`unfuse_equalized_layers` can restore them, e.g., to resume training.
+
+    Args:
+        model (nn.Module): The network, modified in place.
+    """
+    if getattr(model, 'fused_equalized_layers', None) is not None:
+        return
+    replaced_layers = []
+    for module in list(model.modules()):
+        if hasattr(module, 'fold_scale'):
+            module.fold_scale()
+        for name, child in list(module.named_children()):
+            if type(child).__name__ in ('EqualLinear', 'EqualConv2d'):
+                setattr(module, name, _equal_to_plain(child))
+                # keep the layer, but not its weights
+                del child.weight
+                if child.bias is not None:
+                    del child.bias
+                replaced_layers.append((module, name, child))
+    model.fused_equalized_layers = replaced_layers
+
+
+def unfuse_equalized_layers(model):
+    """Reverse :func:`fuse_equalized_layers`, in place."""
+    replaced_layers = getattr(model, 'fused_equalized_layers', None)
+    if replaced_layers is None:
+        return
+    for module, name, layer in replaced_layers:
+        setattr(module, name, _plain_to_equal(getattr(module, name), layer))
+    for module in model.modules():
+        if hasattr(module, 'unfold_scale'):
+            module.unfold_scale()
+    model.fused_equalized_layers = None
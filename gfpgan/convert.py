@@ -0,0 +1,178 @@
+import math
+import torch
+from collections import OrderedDict
+
+DEPLOY_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def infer_network_meta(state_dict):
+    """Infer the network of a GFPGAN or RestoreFormer state dict, as recorded in the 'meta' header.
+
+    The arch is told by the key layout: RestoreFormer has a codebook, and GFPGANv1Clean plain convolutions. The
+    original and bilinear architectures have the same key layout, their arch cannot be told. The out_size of GFPGAN is
+    given by the number of encoder levels, and the channel_multiplier by the input channels of the last ToRGB layer.
+
+    Args:
+        state_dict (dict): The state dict of the network.
+
+    Returns:
+        dict: 'arch' (None for the original and bilinear architectures) and 'out_size', and 'channel_multiplier' for
+            GFPGAN.
+    """
+    if 'quantize.embedding.weight' in state_dict:
+        return {'arch': 'RestoreFormer', 'out_size': 512}
+    num_levels = len({key.split('.')[1] for key in state_dict if key.startswith('conv_body_down.')})
+    out_size = 2**(num_levels + 2)
+    # the StyleGAN2 channels at resolution r (>= 64) are 2**14 / r * channel_multiplier
+    to_rgb_weight = state_dict[f'stylegan_decoder.to_rgbs.{num_levels - 1}.modulated_conv.weight']
+    return {
+        'arch': 'clean' if 'conv_body_first.weight' in state_dict else None,
+        'channel_multiplier': to_rgb_weight.shape[2] * out_size // 2**14,
+        'out_size': out_size
+    }
+
+
+def make_deploy_checkpoint(checkpoint, arch=None, channel_multiplier=None, out_size=None, dtype='fp32'):
+    """Make an inference-only deploy checkpoint from a training checkpoint.
+
+    Only the generator weights used for inference are kept: 'params_ema' if the checkpoint has it, else 'params'.
+    They are stored under 'params_ema', so the deploy checkpoint can be loaded as a released checkpoint. A small
+    'meta' header records the network, so that :class:`gfpgan.utils.GFPGANer` can build it without extra flags.
+
+    Args:
+        checkpoint (dict): The training checkpoint.
+        arch (str): The GFPGAN architecture. Option: clean | bilinear | original | RestoreFormer. Default: None, which
+            infers it from the state dict, see :func:`infer_network_meta`. It is required for the original and
+            bilinear architectures.
+        channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: None, which infers it.
+        out_size (int): The spatial size of outputs. Default: None, which infers it.
+        dtype (str): The data type of the stored floating point weights. Option: fp32 | fp16 | bf16.
+            Default: 'fp32'.
+
+    Returns:
+        dict: The deploy checkpoint, with 'params_ema' and 'meta'.
+    """
+    if dtype not in DEPLOY_DTYPES:
+        raise ValueError(f'Wrong dtype: {dtype}. Supported ones are: {list(DEPLOY_DTYPES.keys())}.')
+    if 'params_ema' in checkpoint:
+        keyname = 'params_ema'
+    else:
+        keyname = 'params'
+
+    meta = infer_network_meta(checkpoint[keyname])
+    for key, value in (('arch', arch), ('channel_multiplier', channel_multiplier), ('out_size', out_size)):
+        if value is not None:
+            meta[key] = value
+    if meta['arch'] is None:
+        raise ValueError('The original and bilinear architectures have the same checkpoint layout, pass the arch.')
+    meta['dtype'] = dtype
+
+    state_dict = OrderedDict()
+    for key, value in checkpoint[keyname].items():
+        if value.is_floating_point():
+            value = value.to(DEPLOY_DTYPES[dtype])
+        state_dict[key] = value.contiguous()
+    return {'params_ema': state_dict, 'meta': meta}
+
+
+def save_deploy_checkpoint(deploy_checkpoint, save_path):
+    """Save a deploy checkpoint.
+
+    Paths ending with '.safetensors' are saved with safetensors, with the 'meta' header stored as metadata. Other
+    paths are saved with ``torch.save``.
+
+    Args:
+        deploy_checkpoint (dict): The deploy checkpoint made by :func:`make_deploy_checkpoint`.
+        save_path (str): The path to save the deploy checkpoint.
+    """
+    if save_path.endswith('.safetensors'):
+        from safetensors.torch import save_file
+        metadata = {key: str(value) for key, value in deploy_checkpoint['meta'].items()}
+        save_file(deploy_checkpoint['params_ema'], save_path, metadata=metadata)
+    else:
+        torch.save(deploy_checkpoint, save_path)
+
+
+def _equal_scale(weight):
+    """The equalized learning rate scale of a weight: 1 / sqrt(fan_in)."""
+    if weight.ndim == 5:  # modulated conv weight: (1, c_out, c_in, k, k)
+        fan_in = weight[0, 0].numel()
+    else:  # linear (c_out, c_in) or conv (c_out, c_in, k, k) weight
+        fan_in = weight[0].numel()
+    return 1 / math.sqrt(fan_in)
+
+
+def _convert_bilinear_key(key, value, lr_mlp):
+    """Get the GFPGANv1Clean key and multiplier of a GFPGANBilinear parameter, see convert_bilinear_to_clean."""
+    sqrt2 = math.sqrt(2)
+    parts = key.split('.')
+    if parts[0] == 'stylegan_decoder':
+        if parts[1] == 'style_mlp':
+            # EqualLinear(fused_lrelu) -> Linear + LeakyReLU, which takes two indices in the clean nn.Sequential
+            parts[2] = str(int(parts[2]) * 2 - 1)
+            if parts[-1] == 'weight':
+                return '.'.join(parts), _equal_scale(value) * lr_mlp * sqrt2
+            return '.'.join(parts), lr_mlp * sqrt2
+        if parts[-2] in ('modulated_conv', 'modulation') and parts[-1] == 'weight':
+            return key, _equal_scale(value)
+        if parts[1] in ('style_conv1', 'style_convs'):
+            # StyleConv: the sqrt(2) of FusedLeakyReLU moves to the noise weight and the bias
+            if parts[-2] == 'activate':  # FusedLeakyReLU bias -> StyleConv bias
+                return '.'.join(parts[:-2] + ['bias']), sqrt2
+            if parts[-1] == 'weight':  # noise weight
+                return key, sqrt2
+        return key, 1
+    if parts[0] in ('conv_body_first', 'final_conv'):
+        # ConvLayer: EqualConv2d + FusedLeakyReLU -> Conv2d + leaky ReLU
+        if parts[-1] == 'weight':
+            return f'{parts[0]}.weight', _equal_scale(value) * sqrt2
+        return f'{parts[0]}.bias', sqrt2
+    if parts[0] in ('conv_body_down', 'conv_body_up'):
+        # ResBlock / ResUpBlock: the final division by sqrt(2) is compensated by the FusedLeakyReLU of conv2, and is
+        # folded into the skip
+        name = parts[2]
+        new_key = f'{parts[0]}.{parts[1]}.{name}.{parts[-1]}'
+        if name == 'conv1':
+            if parts[-1] == 'weight':
+                return new_key, _equal_scale(value) * sqrt2
+            return new_key, sqrt2
+        if name == 'conv2':
+            if parts[-1] == 'weight':
+                return new_key, _equal_scale(value)
+            return new_key, 1
+        return new_key, _equal_scale(value) / sqrt2  # skip
+    if parts[0] in ('condition_scale', 'condition_shift'):
+        # EqualConv2d + ScaledLeakyReLU + EqualConv2d
+        gain = sqrt2 if parts[2] == '0' else 1
+        if parts[-1] == 'weight':
+            return key, _equal_scale(value) * gain
+        return key, gain
+    if parts[0] in ('toRGB', 'final_linear') and parts[-1] == 'weight':
+        return key, _equal_scale(value)
+    return key, 1
+
+
+def convert_bilinear_to_clean(state_dict, lr_mlp=0.01):
+    """Convert a GFPGANBilinear state dict to a GFPGANv1Clean one.
+
+    The two architectures compute the same function. The bilinear layers use equalized learning rates (the weights
+    are scaled by 1 / sqrt(fan_in) in the forward pass) and FusedLeakyReLU (leaky_relu(x + b) * sqrt(2)), the clean
+    layers are plain. The scales are folded into the weights, and since leaky_relu(a * x) = a * leaky_relu(x) for
+    a > 0, the sqrt(2) gains are folded into the layers before the activations.
+
+    Args:
+        state_dict (dict): The GFPGANBilinear state dict.
+        lr_mlp (float): Learning rate multiplier of the style MLP of GFPGANBilinear. Default: 0.01.
+
+    Returns:
+        OrderedDict: The GFPGANv1Clean state dict, with the same dtypes.
+    """
+    clean_state_dict = OrderedDict()
+    for key, value in state_dict.items():
+        new_key, multiplier = _convert_bilinear_key(key, value, lr_mlp)
+        if multiplier != 1:
+            value = (value.float() * multiplier).to(value.dtype)
+        if new_key.startswith('stylegan_decoder.style_conv') and key.endswith('.activate.bias'):
+            value = value.view(1, -1, 1, 1)  # the StyleConv bias of the clean architecture
+        clean_state_dict[new_key] = value
+    return clean_state_dict
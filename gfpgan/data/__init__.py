@@ -1,10 +1,9 @@
-import importlib
-from basicsr.utils import scandir
+from basicsr.utils.registry import DATASET_REGISTRY
 from os import path as osp
 
-# automatically scan and import dataset modules for registry
+from gfpgan.registry import register_lazy_modules
+
 # scan all the files that end with '_dataset.py' under the data folder
+# the dataset modules are imported on the first DATASET_REGISTRY lookup of one of their datasets
 data_folder = osp.dirname(osp.abspath(__file__))
-dataset_filenames = [osp.splitext(osp.basename(v))[0] for v in scandir(data_folder) if v.endswith('_dataset.py')]
-# import all the dataset modules
-_dataset_modules = [importlib.import_module(f'gfpgan.data.{file_name}') for file_name in dataset_filenames]
+register_lazy_modules(DATASET_REGISTRY, 'DATASET_REGISTRY', 'gfpgan.data', data_folder, '_dataset.py')
@@ -0,0 +1,162 @@
+import numpy as np
+import os
+import torch
+from contextlib import contextmanager
+from torch import nn
+
+from gfpgan.archs.stylegan2_clean_arch import ModulatedConv2d
+
+
+class ExportWrapper(nn.Module):
+    """Wrap a restoration network to export the restored faces only.
+
+    Args:
+        model (nn.Module): GFPGANv1Clean or RestoreFormer, in eval mode.
+        randomize_noise (bool): Randomize the noise injection of StyleGAN2. If False, the noise stored in the network
+            is used, so that the exported graph is deterministic. Default: False.
+    """
+
+    def __init__(self, model, randomize_noise=False):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+        self.randomize_noise = randomize_noise
+
+    def forward(self, x):
+        return self.model(x, return_rgb=False, randomize_noise=self.randomize_noise)[0]
+
+
+@contextmanager
+def modulate_inputs(model):
+    """Temporarily run the modulated convolutions of a network in 'input' modulate mode.
+
+    See :class:`gfpgan.archs.stylegan2_clean_arch.ModulatedConv2d`: without the grouped convolution, the graph does
+    not depend on the batch size.
+    """
+    modulated_convs = [module for module in model.modules() if isinstance(module, ModulatedConv2d)]
+    modulate_modes = [module.modulate_mode for module in modulated_convs]
+    for module in modulated_convs:
+        module.modulate_mode = 'input'
+    try:
+        yield model
+    finally:
+        for module, modulate_mode in zip(modulated_convs, modulate_modes):
+            module.modulate_mode = modulate_mode
+
+
+def export_onnx(model, save_path, opset_version=17, input_size=512):
+    """Export GFPGANv1Clean or RestoreFormer to ONNX, with a dynamic batch axis.
+
+    The graph takes normalized RGB faces (b, 3, input_size, input_size) in [-1, 1] named 'input', and returns the
+    restored faces named 'output', like the PyTorch network.
+
+    Args:
+        model (nn.Module): GFPGANv1Clean or RestoreFormer with fp32 weights.
+        save_path (str): The path to save the ONNX graph.
+        opset_version (int): The ONNX opset version. Default: 17.
+        input_size (int): The size of the input faces, the out_size of GFPGANv1Clean. Default: 512.
+    """
+    model.eval()
+    # trace with a batch of 2, so that no batch size of 1 is baked into the graph
+    dummy_input = torch.randn(2, 3, input_size, input_size, device=next(model.parameters()).device)
+    with torch.no_grad(), modulate_inputs(model):
+        torch.onnx.export(
+            ExportWrapper(model).eval(),
+            dummy_input,
+            save_path,
+            input_names=['input'],
+            output_names=['output'],
+            dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+            opset_version=opset_version)
+
+
+@torch.no_grad()
+def verify_onnx(model, onnx_path, batch_sizes=(1, 3), input_size=512):
+    """Compare an exported graph with the eager network, on random inputs of several batch sizes.
+
+    The eager network runs in its own modulate mode, so that the 'input' modulate mode of the graph is checked too.
+
+    Args:
+        model (nn.Module): The exported network with fp32 weights, on CPU.
+        onnx_path (str): The path to the ONNX graph.
+        batch_sizes (tuple[int]): The batch sizes to check. Default: (1, 3).
+        input_size (int): The size of the input faces, as exported. Default: 512.
+
+    Returns:
+        float: The max absolute difference between the outputs, in the [-1, 1] output range.
+    """
+    model.eval()
+    session = OnnxRuntimeGFPGAN(onnx_path, device=torch.device('cpu'))
+    max_diff = 0
+    for batch_size in batch_sizes:
+        x = torch.rand(batch_size, 3, input_size, input_size) * 2 - 1
+        output = ExportWrapper(model)(x)
+        onnx_output, _ = session(x)
+        max_diff = max(max_diff, (output - onnx_output).abs().max().item())
+    return max_diff
+
+
+class OnnxRuntimeGFPGAN():
+    """Run an exported GFPGAN graph with onnxruntime, with the calling convention of the PyTorch networks.
+
+    Args:
+        onnx_path (str): The path to the ONNX graph exported by :func:`export_onnx`.
+        device (torch.device): Runs with the CUDA execution provider on CUDA devices, else on CPU.
+    """
+
+    def __init__(self, onnx_path, device):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if device.type == 'cuda':
+            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+        else:
+            providers = ['CPUExecutionProvider']
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=providers)
+        self.nbytes = os.path.getsize(onnx_path)
+
+    def __call__(self, x, **kwargs):
+        """Restore a batch of faces. Keyword arguments of the PyTorch networks (e.g., weight) are ignored."""
+        try:
+            output = self.session.run(['output'], {'input': x.float().cpu().numpy()})[0]
+        except Exception as error:  # onnxruntime raises its own exceptions, restore_faces handles RuntimeError
+            raise RuntimeError(f'onnxruntime: {error}') from error
+        return torch.from_numpy(np.ascontiguousarray(output)), None
+
+
+def export_torchscript(model, save_path):
+    """Export GFPGANv1Clean or RestoreFormer to a frozen TorchScript module.
+
+    The module is self-contained: it is loaded with ``torch.jit.load``, without building the Python modules of the
+    network nor initializing their weights. It keeps the random noise injection of the PyTorch network, and has no
+    batch size baked in (see :func:`modulate_inputs`).
+
+    Args:
+        model (nn.Module): GFPGANv1Clean or RestoreFormer with fp32 weights.
+        save_path (str): The path to save the TorchScript module.
+    """
+    model.eval()
+    dummy_input = torch.randn(2, 3, 512, 512, device=next(model.parameters()).device)
+    with torch.no_grad(), modulate_inputs(model):
+        # the random noise makes the outputs of two runs differ, the trace check would always fail
+        traced = torch.jit.trace(ExportWrapper(model, randomize_noise=True), dummy_input, check_trace=False)
+    frozen = torch.jit.freeze(traced.eval())
+    torch.jit.save(frozen, save_path)
+
+
+class TorchScriptGFPGAN():
+    """Run a TorchScript module exported by :func:`export_torchscript`, with the calling convention of the PyTorch
+    networks.
+
+    Args:
+        model_path (str): The path to the TorchScript module.
+        device (torch.device): The device to load the module on.
+    """
+
+    def __init__(self, model_path, device):
+        self.module = torch.jit.load(model_path, map_location=device)
+        self.nbytes = os.path.getsize(model_path)
+
+    def __call__(self, x, **kwargs):
+        """Restore a batch of faces. Keyword arguments of the PyTorch networks (e.g., weight) are ignored."""
+        return self.module(x), None
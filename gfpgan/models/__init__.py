@@ -1,10 +1,9 @@
-import importlib
-from basicsr.utils import scandir
+from basicsr.utils.registry import MODEL_REGISTRY
 from os import path as osp
 
-# automatically scan and import model modules for registry
+from gfpgan.registry import register_lazy_modules
+
 # scan all the files that end with '_model.py' under the model folder
+# the model modules are imported on the first MODEL_REGISTRY lookup of one of their models
 model_folder = osp.dirname(osp.abspath(__file__))
-model_filenames = [osp.splitext(osp.basename(v))[0] for v in scandir(model_folder) if v.endswith('_model.py')]
-# import all the model modules
-_model_modules = [importlib.import_module(f'gfpgan.models.{file_name}') for file_name in model_filenames]
+register_lazy_modules(MODEL_REGISTRY, 'MODEL_REGISTRY', 'gfpgan.models', model_folder, '_model.py')
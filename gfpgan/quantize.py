@@ -0,0 +1,101 @@
+import torch
+import warnings
+from torch import nn
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare, quantize_dynamic
+
+
+class QuantizedConv(nn.Module):
+    """Run a float convolution in int8: quantize the input, convolve, and dequantize the output.
+
+    The layers around the convolution stay float, so that any convolution of the network can be quantized on its own.
+
+    Args:
+        conv (nn.Conv2d): The float convolution.
+    """
+
+    def __init__(self, conv):
+        super(QuantizedConv, self).__init__()
+        self.quant = QuantStub()
+        self.conv = conv
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def prepare_quantization(model, backend='fbgemm'):
+    """Prepare a GFPGANv1Clean network for int8 inference on CPU, in place.
+
+    The nn.Linear layers (the style MLP, final_linear and the modulation of each ModulatedConv2d) are dynamically
+    quantized: their weights are int8 and their activations are quantized on the fly. The plain nn.Conv2d layers (the
+    U-Net encoder/decoder, the SFT condition branches and the intermediate toRGB) are statically quantized: observers
+    record the range of their inputs and outputs during calibration, see :func:`convert_quantization`. The modulated
+    convolutions of the StyleGAN2 decoder stay float, their weights are computed from the style of each face.
+
+    Args:
+        model (nn.Module): The float network, in eval mode.
+        backend (str): The quantized engine. Option: fbgemm (x86) | qnnpack (ARM). Default: 'fbgemm'.
+
+    Returns:
+        nn.Module: The prepared network. Run it on calibration faces before :func:`convert_quantization`.
+    """
+    torch.backends.quantized.engine = backend
+    quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    qconfig = get_default_qconfig(backend)
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if type(child) is nn.Conv2d:
+                wrapped_conv = QuantizedConv(child)
+                wrapped_conv.qconfig = qconfig
+                setattr(module, name, wrapped_conv)
+    prepare(model, inplace=True)
+    return model
+
+
+def convert_quantization(model):
+    """Convert a prepared and calibrated network to int8, in place."""
+    convert(model, inplace=True)
+    return model
+
+
+def build_quantized_network(model, backend='fbgemm'):
+    """Give a float network the structure of its int8 version, so that a quantized state dict can be loaded.
+
+    Args:
+        model (nn.Module): The float network, in eval mode.
+        backend (str): The quantized engine the state dict was made for. Default: 'fbgemm'.
+
+    Returns:
+        nn.Module: The int8 network, whose quantization parameters are overwritten by the loaded state dict.
+    """
+    prepare_quantization(model, backend=backend)
+    with warnings.catch_warnings():
+        # the observers are not calibrated, their quantization parameters come from the state dict
+        warnings.simplefilter('ignore', UserWarning)
+        convert_quantization(model)
+    return model
+
+
+def save_quantized_checkpoint(model, save_path, channel_multiplier=2, out_size=512, backend='fbgemm'):
+    """Save an int8 GFPGANv1Clean network.
+
+    The checkpoint has the layout of a deploy checkpoint (see gfpgan/convert.py), with the quantization recorded in
+    its 'meta' header, so that :class:`gfpgan.utils.GFPGANer` loads it directly. Quantized tensors cannot be stored
+    with safetensors, the checkpoint is saved with ``torch.save``.
+
+    Args:
+        model (nn.Module): The converted int8 network.
+        save_path (str): The path to save the checkpoint.
+        channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: 2.
+        out_size (int): The spatial size of outputs. Default: 512.
+        backend (str): The quantized engine of the network. Default: 'fbgemm'.
+    """
+    meta = {
+        'arch': 'clean',
+        'channel_multiplier': channel_multiplier,
+        'out_size': out_size,
+        'dtype': 'fp32',
+        'quantization': 'int8',
+        'quantization_backend': backend
+    }
+    torch.save({'params_ema': model.state_dict(), 'meta': meta}, save_path)
@@ -0,0 +1,61 @@
+import ast
+import importlib
+from basicsr.utils import scandir
+from os import path as osp
+
+
+def scan_registered_names(file_path, registry_name):
+    """Scan the names registered by a module, without importing it.
+
+    Args:
+        file_path (str): The path to the module file.
+        registry_name (str): The name of the registry in the module, e.g., 'ARCH_REGISTRY'.
+
+    Returns:
+        list[str]: The names of the classes and functions decorated with ``@<registry_name>.register()``.
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=file_path)
+    names = []
+    for node in tree.body:
+        if not isinstance(node, (ast.ClassDef, ast.FunctionDef)):
+            continue
+        for decorator in node.decorator_list:
+            func = decorator.func if isinstance(decorator, ast.Call) else decorator
+            if (isinstance(func, ast.Attribute) and func.attr == 'register' and isinstance(func.value, ast.Name)
+                    and func.value.id == registry_name):
+                names.append(node.name)
+    return names
+
+
+def register_lazy_modules(registry, registry_name, package, folder, file_suffix):
+    """Record the names registered by the modules of a folder, and only import a module when one of its names is
+    first requested from the registry.
+
+    The modules are scanned (not imported) up front. ``registry.get`` is wrapped to import the module of a name on
+    its first lookup, so that ``registry.get(name)`` and ``build_network`` (and the like) keep working. Iterating
+    over the registry only lists the names of the modules imported so far.
+
+    Args:
+        registry (Registry): The basicsr registry, e.g., ARCH_REGISTRY.
+        registry_name (str): The name of the registry in the modules, e.g., 'ARCH_REGISTRY'.
+        package (str): The package of the modules, e.g., 'gfpgan.archs'.
+        folder (str): The folder of the modules.
+        file_suffix (str): The suffix of the module files, e.g., '_arch.py'.
+    """
+    lazy_modules = getattr(registry, '_lazy_modules', None)
+    if lazy_modules is None:
+        lazy_modules = registry._lazy_modules = {}
+        eager_get = registry.get
+
+        def get(name, suffix='basicsr'):
+            if name not in registry and name in lazy_modules:
+                importlib.import_module(lazy_modules[name])
+            return eager_get(name, suffix)
+
+        registry.get = get
+
+    for file_path in sorted(scandir(folder, suffix=file_suffix)):
+        module_name = osp.splitext(osp.basename(file_path))[0]
+        for name in scan_registered_names(osp.join(folder, file_path), registry_name):
+            lazy_modules[name] = f'{package}.{module_name}'
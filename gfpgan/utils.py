@@ -1,56 +1,318 @@
+import copy
 import cv2
+import numpy as np
 import os
+import pickle
+import threading
 import torch
-from basicsr.utils import img2tensor, tensor2img
 from basicsr.utils.download_util import load_file_from_url
+from collections import OrderedDict
 from facexlib.utils.face_restoration_helper import FaceRestoreHelper
-from torchvision.transforms.functional import normalize
+from torch.nn import functional as F
 
-from gfpgan.archs.gfpgan_bilinear_arch import GFPGANBilinear
-from gfpgan.archs.gfpganv1_arch import GFPGANv1
 from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.convert import convert_bilinear_to_clean, infer_network_meta
 
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# inference precisions of GFPGANer
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+# face detection and parsing networks shared by all the face helpers, see acquire_face_helper
+_face_backends = {}
+_face_backends_lock = threading.Lock()
+
+
+def get_module_nbytes(module):
+    """Get the memory taken by the parameters and buffers of a module, in bytes."""
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def load_restoration_weights(model_path):
+    """Load the weights of a restoration network, reading as little of the checkpoint as possible.
+
+    A ``.safetensors`` file, or a ``.safetensors`` sidecar next to the checkpoint, is memory-mapped with safetensors
+    (if installed). Otherwise, the checkpoint is memory-mapped with ``torch.load(mmap=True, weights_only=True)``, so
+    that only the tensors of the selected key are read from disk. Checkpoints that cannot be memory-mapped (legacy
+    format, PyTorch < 2.1, or pickled non-tensor objects) are fully loaded with ``weights_only=False``, which unpickles
+    arbitrary objects: only load trusted checkpoints.
+
+    Args:
+        model_path (str): The path to the checkpoint.
+
+    Returns:
+        dict: The state dict of 'params_ema' if the checkpoint has it, else the one of 'params'. Tensors are on CPU.
+        dict: The meta information of a deploy checkpoint (see gfpgan/convert.py), or an empty dict.
+    """
+    sidecar_path = os.path.splitext(model_path)[0] + '.safetensors'
+    if os.path.isfile(sidecar_path):
+        try:
+            from safetensors import safe_open
+            from safetensors.torch import load_file
+        except ImportError:
+            pass
+        else:
+            with safe_open(sidecar_path, framework='pt') as f:
+                metadata = f.metadata() or {}
+            meta = {key: int(value) if value.isdigit() else value for key, value in metadata.items()}
+            return load_file(sidecar_path, device='cpu'), meta
+
+    try:
+        loadnet = torch.load(model_path, map_location='cpu', mmap=True, weights_only=True)
+    except (TypeError, RuntimeError, pickle.UnpicklingError):
+        # weights_only is True by default from PyTorch 2.6 on, it would fail again on pickled non-tensor objects
+        try:
+            loadnet = torch.load(model_path, map_location='cpu', weights_only=False)
+        except TypeError:  # PyTorch < 1.13 has no weights_only
+            loadnet = torch.load(model_path, map_location='cpu')
+    if 'params_ema' in loadnet:
+        keyname = 'params_ema'
+    else:
+        keyname = 'params'
+    return loadnet[keyname], loadnet.get('meta', {})
+
+
+def acquire_face_helper(upscale, face_size=512, det_model='retinaface_resnet50', use_parse=True, device=None):
+    """Get a FaceRestoreHelper whose face detection and parsing networks are shared.
+
+    The networks are loaded once per (det_model, use_parse, device) backend, and reference counted by the helpers
+    using them. Each returned helper has its own per-image state, but the networks are stateful (e.g., RetinaFace
+    stores the scale of the image being detected): hold the returned lock of the backend around detection, alignment
+    and paste-back. Call :func:`release_face_helper` with the returned key when the helper is not used anymore.
+
+    Args:
+        upscale (float): The upscale of the final output.
+        face_size (int): The size of the aligned faces. Default: 512.
+        det_model (str): The face detection model. Default: 'retinaface_resnet50'.
+        use_parse (bool): Whether to use the face parsing network for paste-back. Default: True.
+        device (torch.device): The device of the networks. Default: None.
+
+    Returns:
+        tuple[FaceRestoreHelper, tuple, threading.Lock]: The face helper, the key of its backend, and the lock of its
+            backend.
+    """
+    key = (det_model, use_parse, str(device))
+    with _face_backends_lock:
+        backend = _face_backends.get(key)
+        if backend is None:
+            template = FaceRestoreHelper(
+                upscale,
+                face_size=512,
+                crop_ratio=(1, 1),
+                det_model=det_model,
+                save_ext='png',
+                use_parse=use_parse,
+                device=device,
+                model_rootpath='gfpgan/weights')
+            backend = _face_backends[key] = {'template': template, 'refcount': 0, 'lock': threading.Lock()}
+        backend['refcount'] += 1
+    # the shallow copy shares the networks, and clean_all gives the copy its own per-image state
+    template = backend['template']
+    face_helper = copy.copy(template)
+    face_helper.upscale_factor = upscale
+    # the alignment template is proportional to the face size, the paste-back follows the face size
+    face_helper.face_size = (face_size, face_size)
+    face_helper.face_template = template.face_template * (face_size / template.face_size[0])
+    face_helper.clean_all()
+    return face_helper, key, backend['lock']
+
+
+def release_face_helper(key):
+    """Release a face helper backend acquired with :func:`acquire_face_helper`.
+
+    The backend is dropped when its last user releases it.
+    """
+    with _face_backends_lock:
+        backend = _face_backends.get(key)
+        if backend is not None:
+            backend['refcount'] -= 1
+            if backend['refcount'] <= 0:
+                del _face_backends[key]
+
+
+def _hashable(value):
+    """Make a construction option hashable for a cache key: lists become tuples, dicts sorted tuples of items."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.items()))
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+class _Identity():
+    """Compare and hash an object by identity in a cache key, and keep it alive, so that its id is not reused."""
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and other.obj is self.obj
+
 
 class GFPGANer():
     """Helper for restoration with GFPGAN.
 
-    It will detect and crop faces, and then resize the faces to 512x512.
+    It will detect and crop faces, and then resize the faces to face_size x face_size (512x512 by default).
     GFPGAN is used to restored the resized faces.
     The background is upsampled with the bg_upsampler.
     Finally, the faces will be pasted back to the upsample background image.
 
     Args:
         model_path (str): The path to the GFPGAN model. It can be urls (will first download it automatically).
+            int8 checkpoints made by scripts/quantize_gfpgan.py run on CPU only.
         upscale (float): The upscale of the final output. Default: 2.
-        arch (str): The GFPGAN architecture. Option: clean | original. Default: clean.
-        channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: 2.
+        arch (str): The GFPGAN architecture. Option: clean | bilinear | original | RestoreFormer. Default: None, which
+            uses the architecture recorded in a deploy checkpoint, or infers it from the weights. It is required for
+            original and bilinear checkpoints without a header. bilinear checkpoints are converted to and run with the
+            clean architecture.
+        channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: None, which uses the
+            value recorded in a deploy checkpoint, or infers it from the weights.
         bg_upsampler (nn.Module): The upsampler for the background. Default: None.
+        precision (str): Precision of the network weights and activations. Option: fp32 | bf16 | fp16.
+            The demodulation of StyleGAN2 and the codebook distances of RestoreFormer are always computed in fp32.
+            The inputs and outputs of the network stay fp32, so the rounding error only comes from the network:
+            bf16 keeps 8 significant bits (unit roundoff u = 2**-8) and fp16 11 bits (u = 2**-11), so every stored
+            activation and weight has a relative error of at most u. The accumulated error against the fp32 output
+            is not bounded by u. Measured on CPU (max abs diff of the uint8 restored faces, and PSNR against fp32, on
+            smooth synthetic 512x512 faces, with randomly initialized networks):
+            GFPGANv1Clean: bf16 4 (49.4 dB), fp16 1 (60.8 dB).
+            RestoreFormer: bf16 59 (37.5 dB), fp16 10 (52.6 dB), a few codes of the codebook flip.
+            It depends on the checkpoint and the faces: measure it with `scripts/benchmark_gfpgan.py --task precision`
+            before switching a deployment. fp16 is meant for CUDA, prefer bf16 on CPU. Default: fp32.
+        compile (bool): Compile the GFPGAN network with torch.compile (PyTorch >= 2.0), specialized for face_size
+            faces and the batch sizes of compile_batch_sizes. Every batch size is compiled and warmed up at
+            construction. Batches are padded to the next compiled batch size. Default: False.
+        compile_batch_sizes (tuple[int]): The batch sizes to compile. Default: (1, 2, 4, 8).
+        compile_cache_dir (str): Persistent directory of the compiled kernels and graphs, shared by the workers so that
+            they do not recompile on every start. The TORCHINDUCTOR_CACHE_DIR environment variable takes precedence.
+            Default: None, which uses gfpgan/weights/compile_cache.
+        backend (str): The runtime of the GFPGAN network. Option: pytorch | onnxruntime | torchscript. onnxruntime
+            runs a graph exported by scripts/export_onnx.py (model_path is the .onnx file), with the stored noise.
+            torchscript loads a frozen module exported by scripts/export_torchscript.py, without building the Python
+            network, for a fast worker startup. For both, arch and channel_multiplier are ignored. Default: 'pytorch'.
+        randomize_noise (bool): Draw new random noise for the noise injection of StyleGAN2 in every forward pass. If
+            False, the noise buffers stored in the network are used: the restorations are reproducible, without random
+            number generation. Ignored by the onnxruntime and torchscript backends. Default: True.
+        face_size (int): The working resolution: faces are aligned to face_size x face_size, restored, and pasted back
+            accordingly. GFPGAN networks only run at the size they were trained at (e.g., 256 for a 256x256
+            checkpoint), which is read from the checkpoint. RestoreFormer is fully convolutional, its 512x512 weights
+            run at any multiple of 32, e.g., 256 for a fast tier of small faces (about 4x less compute). The exported
+            backends run at 512. Default: None, which uses the size of the GFPGAN checkpoint, or 512.
+        fixed_batch_size (int): If set, every forward pass runs on a batch of exactly fixed_batch_size faces (padded
+            with copies of the last face), and at most fixed_batch_size faces are restored at once. The restored faces
+            then do not depend on the other faces of their batch: the matrix multiplications round differently with
+            the batch size. With randomize_noise=False, :meth:`enhance_batch` then matches :meth:`enhance` exactly.
+            With compile, only this batch size is compiled. Default: None.
     """
 
-    def __init__(self, model_path, upscale=2, arch='clean', channel_multiplier=2, bg_upsampler=None, device=None):
+    # process-wide restorer cache, see get_or_create
+    cache_memory_budget = 4 * 1024**3  # in bytes
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+    _build_locks = {}  # one lock per key being built, so that builds do not block the cache
+
+    def __init__(self,
+                 model_path,
+                 upscale=2,
+                 arch=None,
+                 channel_multiplier=None,
+                 bg_upsampler=None,
+                 device=None,
+                 precision='fp32',
+                 compile=False,
+                 compile_batch_sizes=(1, 2, 4, 8),
+                 compile_cache_dir=None,
+                 backend='pytorch',
+                 randomize_noise=True,
+                 face_size=None,
+                 fixed_batch_size=None):
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unsupported precision {precision}, choose from {sorted(PRECISIONS)}.')
         self.upscale = upscale
         self.bg_upsampler = bg_upsampler
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+        self.randomize_noise = randomize_noise
+        self.face_size = face_size
+        self.fixed_batch_size = fixed_batch_size
+        # the face helper keeps per-image state, so one restorer only processes one image at a time
+        self._lock = threading.RLock()
 
         # initialize model
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
+        if model_path.startswith('https://'):
+            model_path = load_file_from_url(
+                url=model_path, model_dir=os.path.join(ROOT_DIR, 'gfpgan/weights'), progress=True, file_name=None)
+        if backend == 'pytorch':
+            self._load_gfpgan(model_path, arch, channel_multiplier)
+        elif backend == 'onnxruntime':
+            if precision != 'fp32' or compile:
+                raise ValueError('The onnxruntime backend runs the exported fp32 graph, without torch.compile.')
+            from gfpgan.export import OnnxRuntimeGFPGAN
+            self.gfpgan = OnnxRuntimeGFPGAN(model_path, device=self.device)
+        elif backend == 'torchscript':
+            if precision != 'fp32' or compile:
+                raise ValueError('The torchscript backend runs the exported fp32 module, without torch.compile.')
+            from gfpgan.export import TorchScriptGFPGAN
+            self.gfpgan = TorchScriptGFPGAN(model_path, device=self.device)
+        else:
+            raise ValueError(f'Unsupported backend {backend}, choose from pytorch | onnxruntime | torchscript.')
+        if backend != 'pytorch':
+            if face_size not in (None, 512):
+                raise ValueError(f'The {backend} backend runs the exported network at 512, not {face_size}.')
+            self.face_size = 512
+        # initialize face helper, its detection and parsing networks are shared with the other restorers
+        self.face_helper, self._face_backend_key, self._face_backend_lock = acquire_face_helper(
+            upscale, face_size=self.face_size, det_model='retinaface_resnet50', use_parse=True, device=self.device)
+
+        # the callable running the network in restore_faces
+        self._gfpgan_forward = self.gfpgan
+        self.compile_batch_sizes = None
+        if compile:
+            if fixed_batch_size is not None:
+                compile_batch_sizes = (fixed_batch_size, )
+            self._compile(sorted(compile_batch_sizes), compile_cache_dir)
+
+    def _load_gfpgan(self, model_path, arch, channel_multiplier):
+        """Build the GFPGAN network and load its weights."""
+        state_dict, meta = load_restoration_weights(model_path)
+        # deploy checkpoints (see gfpgan/convert.py) record the network they were made for, otherwise it is inferred
+        # from the state dict
+        meta = {**infer_network_meta(state_dict), **meta}
+        if arch is None:
+            arch = meta['arch']
+            if arch is None:
+                raise ValueError('The original and bilinear architectures have the same checkpoint layout, pass arch.')
+        if channel_multiplier is None:
+            channel_multiplier = meta.get('channel_multiplier', 2)
+        if arch == 'bilinear':
+            # GFPGANBilinear computes the same function as GFPGANv1Clean, run it with the clean architecture
+            state_dict = convert_bilinear_to_clean(state_dict)
+            arch = 'clean'
+        if arch == 'RestoreFormer':
+            if self.face_size is None:
+                self.face_size = meta.get('out_size', 512)
+            elif self.face_size % 32 != 0:
+                raise ValueError(f'RestoreFormer runs at multiples of 32, not at {self.face_size}.')
+        else:
+            # GFPGAN networks run at the size they were trained at
+            out_size = meta['out_size']
+            if self.face_size is None:
+                self.face_size = out_size
+            elif self.face_size != out_size:
+                raise ValueError(f'The GFPGAN checkpoint is a {out_size}x{out_size} network, it cannot restore '
+                                 f'{self.face_size}x{self.face_size} faces.')
         # initialize the GFP-GAN
         if arch == 'clean':
             self.gfpgan = GFPGANv1Clean(
-                out_size=512,
-                num_style_feat=512,
-                channel_multiplier=channel_multiplier,
-                decoder_load_path=None,
-                fix_decoder=False,
-                num_mlp=8,
-                input_is_latent=True,
-                different_w=True,
-                narrow=1,
-                sft_half=True)
-        elif arch == 'bilinear':
-            self.gfpgan = GFPGANBilinear(
-                out_size=512,
+                out_size=self.face_size,
                 num_style_feat=512,
                 channel_multiplier=channel_multiplier,
                 decoder_load_path=None,
@@ -61,8 +323,9 @@ class GFPGANer():
                 narrow=1,
                 sft_half=True)
         elif arch == 'original':
+            from gfpgan.archs.gfpganv1_arch import GFPGANv1
             self.gfpgan = GFPGANv1(
-                out_size=512,
+                out_size=self.face_size,
                 num_style_feat=512,
                 channel_multiplier=channel_multiplier,
                 decoder_load_path=None,
@@ -75,63 +338,287 @@ class GFPGANer():
         elif arch == 'RestoreFormer':
             from gfpgan.archs.restoreformer_arch import RestoreFormer
             self.gfpgan = RestoreFormer()
-        # initialize face helper
-        self.face_helper = FaceRestoreHelper(
-            upscale,
-            face_size=512,
-            crop_ratio=(1, 1),
-            det_model='retinaface_resnet50',
-            save_ext='png',
-            use_parse=True,
-            device=self.device,
-            model_rootpath='gfpgan/weights')
+        # int8 checkpoints (see gfpgan/quantize.py) are loaded into the quantized structure of the network
+        if meta.get('quantization') == 'int8':
+            if arch != 'clean' or self.device.type != 'cpu' or self.precision != 'fp32':
+                raise ValueError('int8 checkpoints only support the clean architecture, on CPU, with fp32 precision.')
+            from gfpgan.quantize import build_quantized_network
+            self.gfpgan.eval()
+            build_quantized_network(self.gfpgan, backend=meta.get('quantization_backend', 'fbgemm'))
 
-        if model_path.startswith('https://'):
-            model_path = load_file_from_url(
-                url=model_path, model_dir=os.path.join(ROOT_DIR, 'gfpgan/weights'), progress=True, file_name=None)
-        loadnet = torch.load(model_path)
-        if 'params_ema' in loadnet:
-            keyname = 'params_ema'
-        else:
-            keyname = 'params'
-        self.gfpgan.load_state_dict(loadnet[keyname], strict=True)
+        try:
+            # assign the (memory-mapped) checkpoint tensors to the network, instead of copying them
+            self.gfpgan.load_state_dict(state_dict, strict=True, assign=True)
+        except TypeError:  # assign is only supported by PyTorch >= 2.1
+            self.gfpgan.load_state_dict(state_dict, strict=True)
+        del state_dict
         self.gfpgan.eval()
-        self.gfpgan = self.gfpgan.to(self.device)
+        if arch == 'clean' and meta.get('quantization') != 'int8':
+            # merge the scale and shift branches of the SFT conditions, once the checkpoint is loaded
+            self.gfpgan.switch_to_deploy()
+        elif arch == 'RestoreFormer':
+            # merge the q, k and v projections of the attention blocks
+            self.gfpgan.switch_to_deploy()
+        # deploy checkpoints may store half-precision weights, cast them to the inference precision
+        self.gfpgan = self.gfpgan.to(device=self.device, dtype=self.dtype)
+        if arch == 'clean':
+            self.gfpgan.stylegan_decoder.skip_zero_noise()
+            # one modulate mode whatever the batch size, so that enhance and enhance_batch run the same kernels.
+            # 'input' is on par with 'weight' for a single face, and faster for pooled batches
+            self.gfpgan.stylegan_decoder.set_modulate_mode('input')
+
+    def _compile(self, batch_sizes, cache_dir):
+        """Compile the GFPGAN network for the given batch sizes, and warm them up."""
+        if cache_dir is None:
+            cache_dir = os.path.join(ROOT_DIR, 'gfpgan/weights/compile_cache')
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+        try:
+            import torch._inductor.config
+            torch._inductor.config.fx_graph_cache = True  # also cache the compiled graphs, not only the kernels
+        except (ImportError, AttributeError):
+            pass
+        # no dynamic shapes: each (batch size, face size) is specialized, and only the compiled batch sizes are used
+        self._gfpgan_forward = torch.compile(self.gfpgan, dynamic=False)
+        self.compile_batch_sizes = batch_sizes
+        dummy_face = np.zeros((self.face_size, self.face_size, 3), dtype=np.uint8)
+        for batch_size in batch_sizes:
+            self.restore_faces([dummy_face] * batch_size, max_batch_size=batch_size)
+
+    @classmethod
+    def get_or_create(cls,
+                      model_path,
+                      upscale=2,
+                      arch=None,
+                      channel_multiplier=None,
+                      bg_upsampler=None,
+                      device=None,
+                      **kwargs):
+        """Get a restorer from the process-wide cache, or create it if it is not cached.
+
+        Restorers are keyed by (model_path, arch, channel_multiplier, upscale, bg_upsampler, device) and any other
+        construction options, so repeated jobs pay the network construction and weight loading only once. The
+        bg_upsampler is keyed by identity, and the key keeps a reference to it. List options (e.g.,
+        compile_batch_sizes) are keyed as tuples. The cache is a LRU: when the models of the cached restorers take more
+        than ``GFPGANer.cache_memory_budget`` bytes, the least recently used restorers are evicted and closed (see
+        :meth:`close`). The most recently used restorer is always kept.
+
+        The returned restorer is shared by all the callers with the same key. A restorer is built outside of the
+        cache lock: building it does not block the lookups of the other keys.
+
+        Args:
+            Same as :class:`GFPGANer`. Extra keyword arguments are passed to the constructor.
+
+        Returns:
+            GFPGANer: The cached restorer.
+        """
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        key = (model_path, arch, channel_multiplier, upscale, _Identity(bg_upsampler), str(device),
+               _hashable(kwargs))
+
+        with cls._cache_lock:
+            restorer = cls._cache.get(key)
+            if restorer is not None:
+                cls._cache.move_to_end(key)
+                return restorer
+            build_lock = cls._build_locks.setdefault(key, threading.Lock())
+
+        with build_lock:
+            # another caller may have built it while this one was waiting
+            with cls._cache_lock:
+                restorer = cls._cache.get(key)
+                if restorer is not None:
+                    cls._cache.move_to_end(key)
+                    return restorer
+            try:
+                restorer = cls(
+                    model_path,
+                    upscale=upscale,
+                    arch=arch,
+                    channel_multiplier=channel_multiplier,
+                    bg_upsampler=bg_upsampler,
+                    device=device,
+                    **kwargs)
+                evicted = []
+                with cls._cache_lock:
+                    cls._cache[key] = restorer
+                    # evict the least recently used restorers when the memory budget is exceeded
+                    while len(cls._cache) > 1 and sum(
+                            cached.memory_nbytes() for cached in cls._cache.values()) > cls.cache_memory_budget:
+                        evicted.append(cls._cache.popitem(last=False)[1])
+                # release their face helpers outside of the cache lock
+                for evicted_restorer in evicted:
+                    evicted_restorer.close()
+            finally:
+                with cls._cache_lock:
+                    cls._build_locks.pop(key, None)
+        return restorer
+
+    @classmethod
+    def clear_cache(cls):
+        """Drop and close all the restorers of the process-wide cache."""
+        with cls._cache_lock:
+            restorers = list(cls._cache.values())
+            cls._cache.clear()
+        for restorer in restorers:
+            restorer.close()
+
+    def memory_nbytes(self):
+        """Get the memory taken by the restoration network of this restorer, in bytes.
+
+        The face detection and parsing networks are shared by all the restorers, so they are not counted.
+        """
+        if not isinstance(self.gfpgan, torch.nn.Module):  # the onnxruntime and torchscript backends
+            return self.gfpgan.nbytes
+        return get_module_nbytes(self.gfpgan)
+
+    def close(self):
+        """Release the shared face detection and parsing networks used by this restorer."""
+        if self._face_backend_key is not None:
+            release_face_helper(self._face_backend_key)
+            self._face_backend_key = None
+
+    def __del__(self):
+        if getattr(self, '_face_backend_key', None) is not None:
+            self.close()
 
     @torch.no_grad()
-    def enhance(self, img, has_aligned=False, only_center_face=False, paste_back=True, weight=0.5):
+    def enhance(self,
+                img,
+                has_aligned=False,
+                only_center_face=False,
+                paste_back=True,
+                weight=0.5,
+                max_batch_size=8,
+                early_exit=False):
+        """Restore the faces in an image.
+
+        Args:
+            img (ndarray): Input image in BGR order.
+            has_aligned (bool): Whether the input is an already aligned face. Default: False.
+            only_center_face (bool): Only restore the center face. Default: False.
+            paste_back (bool): Whether to paste the restored faces back to the input image. Default: True.
+            weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+            max_batch_size (int): Maximum number of faces fed to the network in one forward pass. Default: 8.
+            early_exit (bool): Stop the StyleGAN2 decoder of the clean architecture early for the faces that are small
+                in the output image, see :meth:`get_decode_sizes`. Ignored for aligned inputs, for the other
+                architectures and backends, and for compiled networks, which would recompile for every decoder
+                resolution. Default: False.
+        """
+        with self._lock:
+            self._prepare_faces(img, has_aligned, only_center_face)
+
+            # face restoration
+            decode_sizes = self.get_decode_sizes() if self._use_early_exit(early_exit, has_aligned) else None
+            restored_faces = self.restore_faces(
+                self.face_helper.cropped_faces, weight=weight, max_batch_size=max_batch_size, decode_sizes=decode_sizes)
+            for restored_face in restored_faces:
+                self.face_helper.add_restored_face(restored_face)
+
+            return self._paste_faces(img, has_aligned, paste_back)
+
+    @torch.no_grad()
+    def enhance_batch(self,
+                      imgs,
+                      has_aligned=False,
+                      only_center_face=False,
+                      paste_back=True,
+                      weight=0.5,
+                      max_batch_size=8,
+                      early_exit=False):
+        """Restore the faces in a list of images.
+
+        The faces of all the images are detected and aligned first. They are then restored together, in shared
+        batches of at most ``max_batch_size`` faces, so that images with a single face do not each pay a batch-of-1
+        forward pass. Finally, the restored faces are sent back to their source images for paste-back. Detection,
+        alignment, restoration and paste-back are the same steps as in :meth:`enhance`, with the same kernels: the
+        modulate mode of the clean architecture is fixed for the restorer. With randomize_noise=False and a
+        fixed_batch_size, the results match those of :meth:`enhance` exactly. Otherwise, the batch size still changes
+        the rounding of the matrix multiplications, by about 1e-6 in the [-1, 1] output range.
+
+        Args:
+            imgs (list[ndarray]): Input images in BGR order.
+            has_aligned (bool): Whether the inputs are already aligned faces. Default: False.
+            only_center_face (bool): Only restore the center face of each image. Default: False.
+            paste_back (bool): Whether to paste the restored faces back to the input images. Default: True.
+            weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+            max_batch_size (int): Maximum number of faces fed to the network in one forward pass. Default: 8.
+            early_exit (bool): See :meth:`enhance`. Default: False.
+
+        Returns:
+            list[tuple]: One (cropped_faces, restored_faces, restored_img) tuple per image, as returned by
+                :meth:`enhance`.
+        """
+        with self._lock:
+            # detect and align the faces of each image, and keep the face helper state for the paste-back
+            face_helper_states = []
+            decode_sizes = [] if self._use_early_exit(early_exit, has_aligned) else None
+            for img in imgs:
+                self._prepare_faces(img, has_aligned, only_center_face)
+                face_helper_states.append(dict(self.face_helper.__dict__))
+                if decode_sizes is not None:
+                    decode_sizes.extend(self.get_decode_sizes())
+
+            # face restoration with the faces of all the images pooled together
+            cropped_faces = [face for state in face_helper_states for face in state['cropped_faces']]
+            restored_faces = self.restore_faces(
+                cropped_faces, weight=weight, max_batch_size=max_batch_size, decode_sizes=decode_sizes)
+
+            results = []
+            for img, state in zip(imgs, face_helper_states):
+                self.face_helper.__dict__.update(state)
+                num_faces = len(self.face_helper.cropped_faces)
+                for restored_face in restored_faces[:num_faces]:
+                    self.face_helper.add_restored_face(restored_face)
+                restored_faces = restored_faces[num_faces:]
+                results.append(self._paste_faces(img, has_aligned, paste_back))
+            return results
+
+    def _prepare_faces(self, img, has_aligned, only_center_face):
+        """Detect and align the faces of an image with the face helper."""
         self.face_helper.clean_all()
 
         if has_aligned:  # the inputs are already aligned
-            img = cv2.resize(img, (512, 512))
+            img = cv2.resize(img, (self.face_size, self.face_size))
             self.face_helper.cropped_faces = [img]
         else:
-            self.face_helper.read_image(img)
-            # get face landmarks for each face
-            self.face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
-            # eye_dist_threshold=5: skip faces whose eye distance is smaller than 5 pixels
-            # TODO: even with eye_dist_threshold, it will still introduce wrong detections and restorations.
-            # align and warp each face
-            self.face_helper.align_warp_face()
-
-        # face restoration
-        for cropped_face in self.face_helper.cropped_faces:
-            # prepare data
-            cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
-            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-            cropped_face_t = cropped_face_t.unsqueeze(0).to(self.device)
+            # the detection network is shared with the other restorers, and keeps the scale of the image it detects
+            with self._face_backend_lock:
+                self.face_helper.read_image(img)
+                # get face landmarks for each face
+                self.face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
+                # eye_dist_threshold=5: skip faces whose eye distance is smaller than 5 pixels
+                # TODO: even with eye_dist_threshold, it will still introduce wrong detections and restorations.
+                # align and warp each face
+                self.face_helper.align_warp_face()
 
-            try:
-                output = self.gfpgan(cropped_face_t, return_rgb=False, weight=weight)[0]
-                # convert to image
-                restored_face = tensor2img(output.squeeze(0), rgb2bgr=True, min_max=(-1, 1))
-            except RuntimeError as error:
-                print(f'\tFailed inference for GFPGAN: {error}.')
-                restored_face = cropped_face
+    def _use_early_exit(self, early_exit, has_aligned):
+        """Whether the faces are restored with the decoder resolutions of :meth:`get_decode_sizes`."""
+        return (early_exit and not has_aligned and self.compile_batch_sizes is None
+                and isinstance(self.gfpgan, GFPGANv1Clean))
+
+    def get_decode_sizes(self, min_decode_size=64):
+        """Pick a StyleGAN2 decoder resolution for each aligned face of the face helper.
+
+        A face covering n x n pixels of the output image gets the smallest power of 2 that is at least n (and at least
+        min_decode_size), up to face_size: the details of a larger decoding would be lost when the face is pasted back.
 
-            restored_face = restored_face.astype('uint8')
-            self.face_helper.add_restored_face(restored_face)
+        Args:
+            min_decode_size (int): The smallest decoder resolution. Default: 64.
 
+        Returns:
+            list[int]: The decoder resolution of each face.
+        """
+        decode_sizes = []
+        for affine_matrix in self.face_helper.affine_matrices:
+            # the affine matrix maps the input image to the aligned face, its scale is the zoom of the alignment
+            zoom = np.sqrt(abs(np.linalg.det(affine_matrix[:, :2])))
+            output_size = max(self.face_size / zoom * self.upscale, min_decode_size)
+            decode_sizes.append(min(2**int(np.ceil(np.log2(output_size))), self.face_size))
+        return decode_sizes
+
+    def _paste_faces(self, img, has_aligned, paste_back):
+        """Paste the restored faces of the face helper back to the input image."""
         if not has_aligned and paste_back:
             # upsample the background
             if self.bg_upsampler is not None:
@@ -140,9 +627,89 @@ class GFPGANer():
             else:
                 bg_img = None
 
-            self.face_helper.get_inverse_affine(None)
-            # paste each restored face to the input image
-            restored_img = self.face_helper.paste_faces_to_input_image(upsample_img=bg_img)
+            # the parsing network is shared with the other restorers
+            with self._face_backend_lock:
+                self.face_helper.get_inverse_affine(None)
+                # paste each restored face to the input image
+                restored_img = self.face_helper.paste_faces_to_input_image(upsample_img=bg_img)
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, restored_img
         else:
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, None
+
+    @torch.no_grad()
+    def restore_faces(self, cropped_faces, weight=0.5, max_batch_size=8, decode_sizes=None):
+        """Restore aligned faces in batches.
+
+        The faces are stacked into chunks of at most ``max_batch_size`` and each chunk is restored with one forward
+        pass. If a chunk fails (e.g., out of memory), its faces are restored one by one, and a face that still fails
+        is returned unchanged.
+
+        Args:
+            cropped_faces (list[ndarray]): Aligned faces in BGR order. They must have the same shape.
+            weight (float): Weight passed to the GFPGAN network. Default: 0.5.
+            max_batch_size (int): Maximum number of faces fed to the network in one forward pass. Default: 8.
+            decode_sizes (list[int] | None): The StyleGAN2 decoder resolution of each face, see
+                :meth:`get_decode_sizes`. The faces of each resolution are batched together, and their restored faces
+                are upsampled to face_size. Only the clean architecture stops early. Default: None.
+
+        Returns:
+            list[ndarray]: Restored faces (uint8, BGR order), in the same order as the inputs.
+        """
+        if self.compile_batch_sizes is not None:
+            max_batch_size = min(max_batch_size, self.compile_batch_sizes[-1])
+        if self.fixed_batch_size is not None:
+            max_batch_size = min(max_batch_size, self.fixed_batch_size)
+        if decode_sizes is None:
+            return self._restore_chunks(cropped_faces, weight, max_batch_size, None)
+        # group the faces by decoder resolution, and put the restored faces back in the input order
+        restored_faces = [None] * len(cropped_faces)
+        for decode_size in sorted(set(decode_sizes)):
+            indices = [i for i, size in enumerate(decode_sizes) if size == decode_size]
+            group_faces = self._restore_chunks([cropped_faces[i] for i in indices], weight, max_batch_size,
+                                               decode_size if decode_size < self.face_size else None)
+            for i, restored_face in zip(indices, group_faces):
+                restored_faces[i] = restored_face
+        return restored_faces
+
+    def _restore_chunks(self, cropped_faces, weight, max_batch_size, decode_size):
+        """Restore aligned faces in chunks of at most max_batch_size, see :meth:`restore_faces`."""
+        restored_faces = []
+        for start in range(0, len(cropped_faces), max_batch_size):
+            chunk = cropped_faces[start:start + max_batch_size]
+            try:
+                restored_faces.extend(self._restore_batch(chunk, weight, decode_size))
+            except RuntimeError as error:
+                if len(chunk) > 1:
+                    print(f'\tFailed batch inference for GFPGAN: {error}. Retry the faces one by one.')
+                for cropped_face in chunk:
+                    try:
+                        restored_faces.extend(self._restore_batch([cropped_face], weight, decode_size))
+                    except RuntimeError as error:
+                        print(f'\tFailed inference for GFPGAN: {error}.')
+                        restored_faces.append(cropped_face.astype('uint8'))
+        return restored_faces
+
+    def _restore_batch(self, cropped_faces, weight, decode_size=None):
+        """Run the GFPGAN network on a list of aligned faces with one forward pass."""
+        num_faces = len(cropped_faces)
+        if self.compile_batch_sizes is not None:
+            # pad to the next compiled batch size, other batch sizes would trigger a recompilation
+            batch_size = next(size for size in self.compile_batch_sizes if size >= num_faces)
+            cropped_faces = list(cropped_faces) + [cropped_faces[-1]] * (batch_size - num_faces)
+        elif self.fixed_batch_size is not None:
+            cropped_faces = list(cropped_faces) + [cropped_faces[-1]] * (self.fixed_batch_size - num_faces)
+        # prepare data: BGR uint8 (n, h, w, 3) -> normalized RGB float (n, 3, h, w) in [-1, 1]
+        cropped_faces_t = torch.from_numpy(np.stack(cropped_faces)).float().div_(255.)
+        cropped_faces_t = cropped_faces_t.flip(3).permute(0, 3, 1, 2).contiguous()
+        cropped_faces_t = cropped_faces_t.to(self.device).sub_(0.5).div_(0.5).to(self.dtype)
+
+        kwargs = {} if decode_size is None else {'decode_size': decode_size}
+        output = self._gfpgan_forward(
+            cropped_faces_t, return_rgb=False, randomize_noise=self.randomize_noise, weight=weight,
+            **kwargs)[0][:num_faces]
+        if output.size(3) != self.face_size:  # early exit, upsample for the paste-back
+            output = F.interpolate(output.float(), size=self.face_size, mode='bilinear', align_corners=False)
+        # convert to images: [-1, 1] RGB float -> BGR uint8, in one shot for the whole batch
+        output = output.float().clamp_(-1, 1).add_(1).div_(2).mul_(255.).round_()
+        output = output.permute(0, 2, 3, 1).flip(3).to(torch.uint8).cpu().numpy()
+        return list(output)
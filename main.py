@@ -102,8 +102,8 @@ class EnhanceThread(QThread):
         self.output_file_path = output_file_path
         self.gfpgan_options = gfpgan_options
 
-        # Initialize GFPGAN model
-        self.gfpgan_restorer = GFPGANer(
+        # Initialize GFPGAN model (cached across jobs, only the first job pays the model loading)
+        self.gfpgan_restorer = GFPGANer.get_or_create(
             model_path=gfpgan_options['model_path'],
             upscale=gfpgan_options['upscale'],
             arch=gfpgan_options['arch'],
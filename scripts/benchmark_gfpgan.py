@@ -0,0 +1,249 @@
+"""Benchmark GFPGAN inference on aligned faces.
+
+Usage:
+    python scripts/benchmark_gfpgan.py --task precision --model_path GFPGANv1.4.pth --input faces/
+    python scripts/benchmark_gfpgan.py --task cold_start --model_path GFPGANv1.4.pth \
+        --torchscript_path GFPGANv1.4-frozen.pt
+    python scripts/benchmark_gfpgan.py --task memory --model_path RestoreFormer.pth --arch RestoreFormer --device cpu
+
+Tasks:
+    precision: time fp32 / bf16 / fp16 inference and measure the error of bf16 / fp16 against fp32.
+    cold_start: time the startup of a fresh worker process (imports, GFPGANer construction, first face), for the
+        pytorch backend and the frozen TorchScript module of scripts/export_torchscript.py.
+    ops: time the vectorized StyleGAN2 ops of gfpgan/archs/native_ops.py against the basicsr reference ones.
+    modulation: time the 'weight' and 'input' modulate modes of ModulatedConv2d (clean and bilinear) for several
+        batch sizes, to tune ModulatedConv2d.modulate_input_min_batch.
+    memory: measure the peak memory of restore_faces for several batch sizes, each in a fresh worker process.
+"""
+import argparse
+import cv2
+import glob
+import json
+import numpy as np
+import os
+import subprocess
+import sys
+import time
+import torch
+from basicsr.metrics.psnr_ssim import calculate_psnr
+from torch.nn import functional as F
+
+from gfpgan.utils import PRECISIONS, GFPGANer
+
+
+def read_faces(folder, num_faces):
+    """Read aligned faces and resize them to 512x512."""
+    if folder is None:
+        raise ValueError('This task needs --input, a folder of aligned faces.')
+    paths = sorted(glob.glob(os.path.join(folder, '*')))[:num_faces]
+    if not paths:
+        raise FileNotFoundError(f'No images found in {folder}.')
+    return [cv2.resize(cv2.imread(path, cv2.IMREAD_COLOR), (512, 512)) for path in paths]
+
+
+def time_restore(restorer, faces, args):
+    """Restore the faces and return the restored faces and the time per face, in ms."""
+    # the noise injection is random, use the same noise for every run so that the outputs are comparable
+    torch.manual_seed(0)
+    restorer.restore_faces(faces[:args.batch_size], max_batch_size=args.batch_size)  # warm up
+    if restorer.device.type == 'cuda':
+        torch.cuda.synchronize(restorer.device)
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    restored_faces = restorer.restore_faces(faces, max_batch_size=args.batch_size)
+    if restorer.device.type == 'cuda':
+        torch.cuda.synchronize(restorer.device)
+    return restored_faces, (time.perf_counter() - start) * 1000 / len(faces)
+
+
+def benchmark_precision(args):
+    faces = read_faces(args.input, args.num_faces)
+    reference = None
+    for precision in args.precisions.split(','):
+        restorer = GFPGANer(args.model_path, arch=args.arch, device=args.device, precision=precision)
+        restored_faces, ms_per_face = time_restore(restorer, faces, args)
+        print(f'{precision}: {ms_per_face:.1f} ms/face')
+        if precision == 'fp32':
+            reference = restored_faces
+        elif reference is not None:
+            max_diff = max(np.abs(a.astype(np.int16) - b).max() for a, b in zip(restored_faces, reference))
+            psnr = np.mean([calculate_psnr(a, b, crop_border=0) for a, b in zip(restored_faces, reference)])
+            print(f'\tagainst fp32: max abs diff {max_diff} (uint8), PSNR {psnr:.2f} dB')
+        restorer.close()
+
+
+def benchmark_cold_start(args):
+    runs = [('pytorch', args.model_path)]
+    if args.torchscript_path is not None:
+        runs.append(('torchscript', args.torchscript_path))
+    for backend, model_path in runs:
+        cmd = [sys.executable, __file__, '--task', 'cold_start_worker', '--model_path', model_path]
+        cmd += ['--backend', backend]
+        if args.arch is not None:
+            cmd += ['--arch', args.arch]
+        if args.device is not None:
+            cmd += ['--device', str(args.device)]
+        timings = []
+        for _ in range(args.num_runs):
+            start = time.perf_counter()
+            stdout = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            timing = json.loads(stdout.splitlines()[-1])
+            timing['total'] = time.perf_counter() - start
+            timings.append(timing)
+        print(f'{backend}: ' + ', '.join(f'{name} {np.median([timing[name] for timing in timings]):.2f} s'
+                                         for name in ('total', 'construction', 'first_face')))
+
+
+def cold_start_worker(args):
+    """Run in a fresh process by benchmark_cold_start, prints the timings as json on the last line."""
+    start = time.perf_counter()
+    restorer = GFPGANer(args.model_path, arch=args.arch, device=args.device, backend=args.backend)
+    construction = time.perf_counter() - start
+    start = time.perf_counter()
+    restorer.restore_faces([np.zeros((restorer.face_size, restorer.face_size, 3), dtype=np.uint8)])
+    first_face = time.perf_counter() - start
+    print(json.dumps({'construction': construction, 'first_face': first_face}))
+
+
+def benchmark_memory(args):
+    for batch_size in [int(batch_size) for batch_size in args.batch_sizes.split(',')]:
+        cmd = [sys.executable, __file__, '--task', 'memory_worker', '--model_path', args.model_path]
+        cmd += ['--batch_size', str(batch_size)]
+        if args.face_size is not None:
+            cmd += ['--face_size', str(args.face_size)]
+        if args.arch is not None:
+            cmd += ['--arch', args.arch]
+        if args.device is not None:
+            cmd += ['--device', str(args.device)]
+        stdout = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+        peak = json.loads(stdout.splitlines()[-1])['peak']
+        print(f'batch {batch_size}: peak {peak / 1024**2:.0f} MB, {peak / batch_size / 1024**2:.0f} MB/face')
+
+
+def memory_worker(args):
+    """Run in a fresh process by benchmark_memory, prints the peak memory of restore_faces as json on the last line.
+
+    The peak is the growth of the CUDA allocated memory on CUDA devices, else the growth of the peak resident set size
+    of the process.
+    """
+    restorer = GFPGANer(args.model_path, arch=args.arch, device=args.device, face_size=args.face_size)
+    faces = [np.zeros((restorer.face_size, restorer.face_size, 3), dtype=np.uint8)] * args.batch_size
+    if restorer.device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(restorer.device)
+        base = torch.cuda.memory_allocated(restorer.device)
+        restorer.restore_faces(faces, max_batch_size=args.batch_size)
+        peak = torch.cuda.max_memory_allocated(restorer.device) - base
+    else:
+        import resource
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        restorer.restore_faces(faces, max_batch_size=args.batch_size)
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base) * 1024  # ru_maxrss is in KB on Linux
+    print(json.dumps({'peak': peak}))
+
+
+def time_op(op, *inputs, num_runs=10):
+    """Return the output of an op and its median time, in ms."""
+    with torch.no_grad():
+        output = op(*inputs)
+        timings = []
+        for _ in range(num_runs):
+            start = time.perf_counter()
+            op(*inputs)
+            timings.append((time.perf_counter() - start) * 1000)
+    return output, np.median(timings)
+
+
+def benchmark_ops(args):
+    from basicsr.archs.stylegan2_arch import make_resample_kernel
+    from basicsr.ops.upfirdn2d.upfirdn2d import upfirdn2d_native
+
+    from gfpgan.archs.native_ops import fused_leaky_relu, upfirdn2d
+
+    def reference_upfirdn2d(x, kernel, up, down, pad):
+        return upfirdn2d_native(x, kernel, up, up, down, down, pad[0], pad[1], pad[0], pad[1])
+
+    def reference_fused_leaky_relu(x, bias):
+        return F.leaky_relu(x + bias.view(1, -1, 1, 1), negative_slope=0.2) * 2**0.5
+
+    device = args.device or torch.device('cpu')
+    kernel = make_resample_kernel([1, 3, 3, 1]).to(device)
+    # (name, reference op, native op, inputs), with the shapes of the StyleGAN2 layers at 512x512
+    cases = [
+        ('upfirdn2d blur', reference_upfirdn2d, upfirdn2d,
+         (torch.randn(args.batch_size, 64, 257, 257, device=device), kernel * 4, 1, 1, (1, 1))),
+        ('upfirdn2d up2', reference_upfirdn2d, upfirdn2d,
+         (torch.randn(args.batch_size, 3, 256, 256, device=device), kernel * 4, 2, 1, (2, 1))),
+        ('upfirdn2d down2', reference_upfirdn2d, upfirdn2d,
+         (torch.randn(args.batch_size, 64, 512, 512, device=device), kernel, 1, 2, (1, 1))),
+        ('fused_leaky_relu', reference_fused_leaky_relu, fused_leaky_relu,
+         (torch.randn(args.batch_size, 64, 512, 512, device=device), torch.randn(64, device=device))),
+    ]
+    for name, reference_op, native_op, inputs in cases:
+        reference, reference_ms = time_op(reference_op, *inputs)
+        output, native_ms = time_op(native_op, *inputs)
+        max_diff = (reference - output).abs().max().item()
+        print(f'{name}: reference {reference_ms:.1f} ms, native {native_ms:.1f} ms '
+              f'({reference_ms / native_ms:.1f}x), max abs diff {max_diff:.2e}')
+
+
+def benchmark_modulation(args):
+    from gfpgan.archs.stylegan2_bilinear_arch import ModulatedConv2d as BilinearModulatedConv2d
+    from gfpgan.archs.stylegan2_clean_arch import ModulatedConv2d as CleanModulatedConv2d
+
+    device = args.device or torch.device('cpu')
+    # (in_channels, out_channels, input size, sample_mode) of StyleGAN2 layers at 512x512, channel multiplier 2
+    layers = [(512, 512, 16, 'upsample'), (512, 256, 32, None), (256, 128, 64, 'upsample'), (128, 64, 128, None)]
+    for arch, modulated_conv_cls in (('clean', CleanModulatedConv2d), ('bilinear', BilinearModulatedConv2d)):
+        for in_channels, out_channels, size, sample_mode in layers:
+            layer = modulated_conv_cls(in_channels, out_channels, 3, 512, sample_mode=sample_mode).to(device).eval()
+            for batch_size in [int(batch_size) for batch_size in args.batch_sizes.split(',')]:
+                x = torch.randn(batch_size, in_channels, size, size, device=device)
+                style = torch.randn(batch_size, 512, device=device)
+                timings = {}
+                outputs = {}
+                for modulate_mode in ('weight', 'input'):
+                    layer.modulate_mode = modulate_mode
+                    outputs[modulate_mode], timings[modulate_mode] = time_op(layer, x, style, num_runs=3)
+                rel_diff = ((outputs['weight'] - outputs['input']).abs().max() / outputs['weight'].abs().max()).item()
+                print(f'{arch} {in_channels}->{out_channels} @{size} {sample_mode}, batch {batch_size}: weight '
+                      f'{timings["weight"]:.1f} ms, input {timings["input"]:.1f} ms, max rel diff {rel_diff:.1e}')
+
+
+TASKS = {
+    'precision': benchmark_precision,
+    'cold_start': benchmark_cold_start,
+    'cold_start_worker': cold_start_worker,
+    'ops': benchmark_ops,
+    'modulation': benchmark_modulation,
+    'memory': benchmark_memory,
+    'memory_worker': memory_worker
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', type=str, default='precision', choices=list(TASKS.keys()), help='Benchmark task')
+    parser.add_argument('--model_path', type=str, default=None, help='GFPGAN model path or url')
+    parser.add_argument(
+        '--arch', type=str, default=None, help='GFPGAN architecture: clean | bilinear | original | RestoreFormer')
+    parser.add_argument('--input', type=str, default=None, help='Folder of aligned faces')
+    parser.add_argument('--num_faces', type=int, default=16, help='Number of faces to restore')
+    parser.add_argument('--batch_size', type=int, default=8, help='Number of faces in one forward pass')
+    parser.add_argument('--device', type=str, default=None, help='Device, e.g. cpu | cuda. Default: auto')
+    parser.add_argument(
+        '--precisions',
+        type=str,
+        default='fp32,bf16,fp16',
+        help=f'Comma-separated precisions, from {sorted(PRECISIONS)}. fp32 first, it is the reference')
+    parser.add_argument('--face_size', type=int, default=None, help='Working resolution of GFPGANer (memory)')
+    parser.add_argument('--torchscript_path', type=str, default=None, help='Frozen TorchScript module (cold_start)')
+    parser.add_argument('--backend', type=str, default='pytorch', help='GFPGANer backend (cold_start_worker)')
+    parser.add_argument('--num_runs', type=int, default=3, help='Number of fresh processes per backend (cold_start)')
+    parser.add_argument(
+        '--batch_sizes', type=str, default='1,8,32', help='Comma-separated batch sizes (modulation, memory)')
+    args = parser.parse_args()
+    if args.model_path is None and args.task not in ('ops', 'modulation'):
+        parser.error(f'--model_path is required by the {args.task} task')
+    if args.device is not None:
+        args.device = torch.device(args.device)
+
+    TASKS[args.task](args)
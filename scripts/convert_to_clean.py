@@ -0,0 +1,76 @@
+"""Convert a GFPGANBilinear checkpoint to the clean architecture (GFPGANv1Clean), and verify the conversion.
+
+The converted network is checked against the bilinear one on random inputs (with the stored noise). Without --input,
+the conversion is checked on randomly initialized weights.
+
+The original architecture (GFPGANv1) cannot be converted: its StyleGAN2 decoder and encoder resample with upfirdn
+blur kernels (and transposed / strided convolutions), which the bilinear resampling of the clean architecture does not
+reproduce.
+
+Usage:
+    python scripts/convert_to_clean.py --input GFPGANv1.3-bilinear.pth --output GFPGANv1.3-clean.pth
+"""
+import argparse
+import sys
+import torch
+
+from gfpgan.archs.gfpgan_bilinear_arch import GFPGANBilinear
+from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.convert import convert_bilinear_to_clean, make_deploy_checkpoint, save_deploy_checkpoint
+from gfpgan.utils import load_restoration_weights
+
+
+@torch.no_grad()
+def verify_conversion(bilinear, clean, batch_size=2):
+    """Get the max absolute difference between the outputs (restored faces and intermediate rgb images)."""
+    x = torch.rand(batch_size, 3, 512, 512) * 2 - 1
+    image, out_rgbs = bilinear(x, return_rgb=True, randomize_noise=False)
+    clean_image, clean_out_rgbs = clean(x, return_rgb=True, randomize_noise=False)
+    diffs = [(a - b).abs().max().item() for a, b in zip([image] + out_rgbs, [clean_image] + clean_out_rgbs)]
+    return max(diffs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default=None, help='Input GFPGANBilinear checkpoint')
+    parser.add_argument('--output', type=str, default=None, help='Output GFPGANv1Clean deploy checkpoint')
+    parser.add_argument('--channel_multiplier', type=int, default=2, help='Channel multiplier of StyleGAN2')
+    parser.add_argument('--atol', type=float, default=1e-3, help='Tolerance of the verification')
+    args = parser.parse_args()
+
+    network_opt = dict(
+        out_size=512,
+        num_style_feat=512,
+        channel_multiplier=args.channel_multiplier,
+        decoder_load_path=None,
+        fix_decoder=False,
+        num_mlp=8,
+        input_is_latent=True,
+        different_w=True,
+        narrow=1,
+        sft_half=True)
+    bilinear = GFPGANBilinear(**network_opt).eval()
+    if args.input is not None:
+        state_dict, _ = load_restoration_weights(args.input)
+        bilinear.load_state_dict(state_dict, strict=True)
+    else:
+        # random weights, also for the biases, so that every parameter is checked
+        torch.manual_seed(0)
+        for param in bilinear.parameters():
+            param.data.normal_(0, 0.1 if param.ndim <= 1 else 1)
+
+    clean_state_dict = convert_bilinear_to_clean(bilinear.state_dict())
+    clean = GFPGANv1Clean(**network_opt).eval()
+    clean.load_state_dict(clean_state_dict, strict=True)
+
+    max_diff = verify_conversion(bilinear, clean)
+    print(f'Max abs difference between the bilinear and clean networks: {max_diff:.2e}')
+    if max_diff > args.atol:
+        sys.exit(f'The converted network differs from the bilinear one by more than {args.atol}.')
+
+    if args.output is not None:
+        deploy_checkpoint = make_deploy_checkpoint({'params_ema': clean_state_dict},
+                                                   arch='clean',
+                                                   channel_multiplier=args.channel_multiplier)
+        save_deploy_checkpoint(deploy_checkpoint, args.output)
+        print(f'Saved to {args.output}')
@@ -0,0 +1,41 @@
+"""Convert a released or training GFPGAN checkpoint to a compact, inference-only deploy checkpoint.
+
+Usage:
+    python scripts/convert_to_deploy.py --input GFPGANv1.4.pth --output GFPGANv1.4-deploy.pth --dtype fp16
+"""
+import argparse
+import os
+import torch
+
+from gfpgan.convert import DEPLOY_DTYPES, make_deploy_checkpoint, save_deploy_checkpoint
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True, help='Input checkpoint')
+    parser.add_argument(
+        '--output', type=str, required=True, help='Output deploy checkpoint, .safetensors is saved with safetensors')
+    parser.add_argument(
+        '--arch',
+        type=str,
+        default=None,
+        help='GFPGAN architecture: clean | bilinear | original | RestoreFormer. Default: inferred from the weights, '
+        'required for original and bilinear')
+    parser.add_argument(
+        '--channel_multiplier', type=int, default=None, help='Channel multiplier of StyleGAN2. Default: inferred')
+    parser.add_argument('--out_size', type=int, default=None, help='The spatial size of outputs. Default: inferred')
+    parser.add_argument(
+        '--dtype', type=str, default='fp32', choices=list(DEPLOY_DTYPES.keys()), help='Data type of the weights')
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.input, map_location='cpu')
+    deploy_checkpoint = make_deploy_checkpoint(
+        checkpoint,
+        arch=args.arch,
+        channel_multiplier=args.channel_multiplier,
+        out_size=args.out_size,
+        dtype=args.dtype)
+    save_deploy_checkpoint(deploy_checkpoint, args.output)
+
+    input_size = os.path.getsize(args.input) / 1024**2
+    output_size = os.path.getsize(args.output) / 1024**2
+    print(f'Saved {args.output}: {output_size:.1f} MB (input: {input_size:.1f} MB).')
@@ -0,0 +1,34 @@
+"""Export a GFPGANv1Clean or RestoreFormer model to ONNX, and verify the graph against the PyTorch network.
+
+The exported graph runs with ``GFPGANer(model_path='xxx.onnx', backend='onnxruntime')``.
+
+Usage:
+    python scripts/export_onnx.py --model_path GFPGANv1.4.pth --output GFPGANv1.4.onnx
+"""
+import argparse
+import sys
+import torch
+
+from gfpgan.export import export_onnx, verify_onnx
+from gfpgan.utils import GFPGANer
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=True, help='GFPGAN model path or url')
+    parser.add_argument('--output', type=str, required=True, help='Output ONNX graph')
+    parser.add_argument('--arch', type=str, default=None, help='GFPGAN architecture: clean | RestoreFormer')
+    parser.add_argument('--channel_multiplier', type=int, default=None, help='Channel multiplier of StyleGAN2')
+    parser.add_argument('--opset_version', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--atol', type=float, default=1e-3, help='Tolerance of the verification, in [-1, 1] range')
+    args = parser.parse_args()
+
+    restorer = GFPGANer(
+        args.model_path, arch=args.arch, channel_multiplier=args.channel_multiplier, device=torch.device('cpu'))
+    export_onnx(restorer.gfpgan, args.output, opset_version=args.opset_version)
+    print(f'Exported to {args.output}')
+
+    max_diff = verify_onnx(restorer.gfpgan, args.output)
+    print(f'Max abs difference against PyTorch: {max_diff:.2e}')
+    restorer.close()
+    if max_diff > args.atol:
+        sys.exit(f'The exported graph differs from the PyTorch network by more than {args.atol}.')
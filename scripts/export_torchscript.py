@@ -0,0 +1,41 @@
+"""Export a GFPGANv1Clean or RestoreFormer model to a frozen TorchScript module, for a fast worker startup.
+
+The exported module runs with ``GFPGANer(model_path='xxx.pt', backend='torchscript')``.
+
+Usage:
+    python scripts/export_torchscript.py --model_path GFPGANv1.4.pth --output GFPGANv1.4-frozen.pt
+"""
+import argparse
+import sys
+import torch
+
+from gfpgan.export import ExportWrapper, TorchScriptGFPGAN, export_torchscript
+from gfpgan.utils import GFPGANer
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=True, help='GFPGAN model path or url')
+    parser.add_argument('--output', type=str, required=True, help='Output TorchScript module')
+    parser.add_argument('--arch', type=str, default=None, help='GFPGAN architecture: clean | RestoreFormer')
+    parser.add_argument('--channel_multiplier', type=int, default=None, help='Channel multiplier of StyleGAN2')
+    parser.add_argument('--atol', type=float, default=1e-3, help='Tolerance of the verification, in [-1, 1] range')
+    args = parser.parse_args()
+
+    restorer = GFPGANer(
+        args.model_path, arch=args.arch, channel_multiplier=args.channel_multiplier, device=torch.device('cpu'))
+    export_torchscript(restorer.gfpgan, args.output)
+    print(f'Exported to {args.output}')
+
+    # verify against the PyTorch network, with the same random noise
+    module = TorchScriptGFPGAN(args.output, device=torch.device('cpu'))
+    x = torch.rand(3, 3, 512, 512) * 2 - 1
+    with torch.no_grad():
+        torch.manual_seed(0)
+        output = ExportWrapper(restorer.gfpgan, randomize_noise=True)(x)
+        torch.manual_seed(0)
+        scripted_output, _ = module(x)
+    max_diff = (output - scripted_output).abs().max().item()
+    print(f'Max abs difference against PyTorch: {max_diff:.2e}')
+    restorer.close()
+    if max_diff > args.atol:
+        sys.exit(f'The exported module differs from the PyTorch network by more than {args.atol}.')
@@ -0,0 +1,90 @@
+"""Quantize a GFPGANv1Clean model to int8 for CPU inference, and report its quality against fp32.
+
+The statically quantized convolutions are calibrated on a folder of aligned faces. The quality is measured on another
+folder of aligned faces (PSNR, and LPIPS if the lpips package is installed).
+
+Usage:
+    python scripts/quantize_gfpgan.py --model_path GFPGANv1.4.pth --calib faces/calib --val faces/val \
+        --output GFPGANv1.4-int8.pth
+"""
+import argparse
+import cv2
+import glob
+import numpy as np
+import os
+import time
+import torch
+from basicsr.metrics.psnr_ssim import calculate_psnr
+from basicsr.utils import img2tensor
+
+from gfpgan.quantize import convert_quantization, prepare_quantization, save_quantized_checkpoint
+from gfpgan.utils import GFPGANer
+
+
+def read_faces(folder, num_faces):
+    """Read aligned faces and resize them to 512x512."""
+    paths = sorted(glob.glob(os.path.join(folder, '*')))[:num_faces]
+    if not paths:
+        raise FileNotFoundError(f'No images found in {folder}.')
+    return [cv2.resize(cv2.imread(path, cv2.IMREAD_COLOR), (512, 512)) for path in paths]
+
+
+def restore_and_time(restorer, faces):
+    torch.manual_seed(0)  # the same injected noise for fp32 and int8
+    start = time.perf_counter()
+    restored_faces = restorer.restore_faces(faces)
+    return restored_faces, (time.perf_counter() - start) * 1000 / len(faces)
+
+
+def report_quality(restored_faces, reference_faces):
+    psnr = np.mean([calculate_psnr(a, b, crop_border=0) for a, b in zip(restored_faces, reference_faces)])
+    print(f'\tPSNR against fp32: {psnr:.2f} dB')
+    try:
+        import lpips
+    except ImportError:
+        print('\tLPIPS against fp32: skipped, install lpips to compute it')
+        return
+    loss_fn = lpips.LPIPS(net='alex', verbose=False)
+    # lpips takes RGB tensors in [-1, 1]
+    imgs = img2tensor([face.astype(np.float32) / 127.5 - 1 for face in restored_faces], bgr2rgb=True)
+    refs = img2tensor([face.astype(np.float32) / 127.5 - 1 for face in reference_faces], bgr2rgb=True)
+    with torch.no_grad():
+        distance = torch.stack([loss_fn(img[None], ref[None]).flatten() for img, ref in zip(imgs, refs)]).mean()
+    print(f'\tLPIPS against fp32: {distance.item():.4f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=True, help='GFPGANv1Clean model path or url')
+    parser.add_argument('--calib', type=str, required=True, help='Folder of aligned faces for calibration')
+    parser.add_argument('--val', type=str, required=True, help='Folder of aligned faces for the quality report')
+    parser.add_argument('--output', type=str, required=True, help='Output int8 checkpoint')
+    parser.add_argument('--num_calib', type=int, default=64, help='Number of calibration faces')
+    parser.add_argument('--num_val', type=int, default=32, help='Number of validation faces')
+    parser.add_argument('--channel_multiplier', type=int, default=2, help='Channel multiplier of StyleGAN2')
+    parser.add_argument('--backend', type=str, default='fbgemm', help='Quantized engine: fbgemm (x86) | qnnpack (ARM)')
+    args = parser.parse_args()
+
+    calib_faces = read_faces(args.calib, args.num_calib)
+    val_faces = read_faces(args.val, args.num_val)
+    restorer = GFPGANer(
+        args.model_path, arch='clean', channel_multiplier=args.channel_multiplier, device=torch.device('cpu'))
+
+    reference_faces, ms_per_face = restore_and_time(restorer, val_faces)
+    print(f'fp32: {ms_per_face:.1f} ms/face')
+
+    # int8 checkpoints keep the original layout of the condition branches
+    restorer.gfpgan.switch_to_train()
+    # quantize, and calibrate the activation ranges on the calibration faces
+    prepare_quantization(restorer.gfpgan, backend=args.backend)
+    restorer.restore_faces(calib_faces)
+    convert_quantization(restorer.gfpgan)
+
+    restored_faces, ms_per_face = restore_and_time(restorer, val_faces)
+    print(f'int8: {ms_per_face:.1f} ms/face')
+    report_quality(restored_faces, reference_faces)
+
+    save_quantized_checkpoint(
+        restorer.gfpgan, args.output, channel_multiplier=args.channel_multiplier, backend=args.backend)
+    print(f'Saved to {args.output}: {os.path.getsize(args.output) / 1024**2:.1f} MB')
+    restorer.close()
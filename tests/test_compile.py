@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+
+dynamo = pytest.importorskip('torch._dynamo')
+
+
+@pytest.mark.parametrize('sft_half', [False, True])
+def test_gfpganv1_clean_no_graph_breaks(sft_half):
+    """Test GFPGANv1Clean: the deploy-mode inference path compiles to a single graph"""
+    torch.manual_seed(0)
+    net = GFPGANv1Clean(
+        out_size=64,
+        num_style_feat=64,
+        channel_multiplier=1,
+        num_mlp=2,
+        input_is_latent=True,
+        different_w=True,
+        narrow=0.25,
+        sft_half=sft_half)
+    net.eval()
+    net.switch_to_deploy()
+
+    img = torch.rand((2, 3, 64, 64)) * 2 - 1
+    with torch.no_grad():
+        explanation = dynamo.explain(net)(img, return_rgb=False, randomize_noise=False)
+    assert explanation.graph_break_count == 0, explanation.break_reasons
@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from gfpgan.archs.gfpgan_bilinear_arch import GFPGANBilinear
+from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.convert import convert_bilinear_to_clean
+
+NET_OPT = dict(
+    out_size=64,
+    num_style_feat=64,
+    channel_multiplier=1,
+    num_mlp=2,
+    input_is_latent=True,
+    different_w=True,
+    narrow=0.25)
+
+
+def build_bilinear_net(sft_half):
+    torch.manual_seed(0)
+    net = GFPGANBilinear(fix_decoder=False, sft_half=sft_half, **NET_OPT)
+    # the biases and noise weights are initialized to zeros, randomize them to also check their conversion
+    with torch.no_grad():
+        for name, param in net.named_parameters():
+            if name.endswith('bias') or param.numel() == 1:
+                param.normal_(std=0.1)
+    return net.eval()
+
+
+@pytest.mark.parametrize('sft_half', [False, True])
+def test_convert_bilinear_to_clean(sft_half):
+    """Test gfpgan.convert: convert_bilinear_to_clean gives a GFPGANv1Clean with the same outputs"""
+    bilinear_net = build_bilinear_net(sft_half)
+    clean_net = GFPGANv1Clean(fix_decoder=False, sft_half=sft_half, **NET_OPT)
+    clean_net.load_state_dict(convert_bilinear_to_clean(bilinear_net.state_dict()), strict=True)
+    clean_net.eval()
+
+    img = torch.rand((2, 3, 64, 64)) * 2 - 1
+    with torch.no_grad():
+        output, out_rgbs = bilinear_net(img, return_rgb=True, randomize_noise=False)
+        clean_output, clean_out_rgbs = clean_net(img, return_rgb=True, randomize_noise=False)
+    torch.testing.assert_close(clean_output, output, rtol=1e-4, atol=1e-4)
+    assert len(clean_out_rgbs) == len(out_rgbs)
+    for clean_out_rgb, out_rgb in zip(clean_out_rgbs, out_rgbs):
+        torch.testing.assert_close(clean_out_rgb, out_rgb, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,31 @@
+import pytest
+import torch
+
+from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.archs.restoreformer_arch import RestoreFormer
+from gfpgan.export import export_onnx, verify_onnx
+
+pytest.importorskip('onnxruntime')
+
+
+def build_small_net(arch):
+    torch.manual_seed(0)
+    if arch == 'clean':
+        net = GFPGANv1Clean(
+            out_size=64, num_style_feat=64, channel_multiplier=1, num_mlp=2, different_w=True, narrow=0.25)
+    else:
+        # the attention of the encoder and the decoder is at the lowest resolution, 16
+        net = RestoreFormer(
+            n_embed=64, embed_dim=64, ch=32, ch_mult=(1, 2, 2), resolution=64, z_channels=64, head_size=8)
+    return net.eval()
+
+
+@pytest.mark.parametrize('arch', ['clean', 'RestoreFormer'])
+def test_export_onnx(arch, tmp_path):
+    """Test gfpgan.export: the ONNX graph matches the eager network at batch sizes 1 and 3"""
+    net = build_small_net(arch)
+    onnx_path = str(tmp_path / f'{arch}.onnx')
+    export_onnx(net, onnx_path, input_size=64)
+    # the eager network runs in its own modulate mode, the graph in 'input' modulate mode
+    max_diff = verify_onnx(net, onnx_path, batch_sizes=(1, 3), input_size=64)
+    assert max_diff < 1e-3
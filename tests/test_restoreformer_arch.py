@@ -0,0 +1,24 @@
+import torch
+
+from gfpgan.archs.restoreformer_arch import RestoreFormer
+
+
+def test_restoreformer_switch_to_deploy():
+    """Test RestoreFormer: the merged q, k and v projections of the deploy mode give the same outputs"""
+    torch.manual_seed(0)
+    net = RestoreFormer(n_embed=64, embed_dim=64, ch=32, ch_mult=(1, 2, 2), resolution=64, z_channels=64, head_size=8)
+    net.eval()
+    state_dict = {key: value.clone() for key, value in net.state_dict().items()}
+
+    img = torch.rand((2, 3, 64, 64)) * 2 - 1
+    with torch.no_grad():
+        output = net(img)[0]
+        net.switch_to_deploy()
+        deploy_output = net(img)[0]
+    torch.testing.assert_close(deploy_output, output, rtol=1e-5, atol=1e-5)
+
+    # switch_to_train restores the original state dict layout
+    net.switch_to_train()
+    assert net.state_dict().keys() == state_dict.keys()
+    for key, value in net.state_dict().items():
+        assert torch.equal(value, state_dict[key])
@@ -0,0 +1,97 @@
+import cv2
+import numpy as np
+import pytest
+import threading
+import torch
+from basicsr.metrics import calculate_psnr
+
+import gfpgan.utils
+from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.utils import GFPGANer
+
+
+class AlignedFaceHelper():
+    """Stand-in for the facexlib face helper, for aligned faces only: no detection network is downloaded."""
+
+    def __init__(self):
+        self.clean_all()
+
+    def clean_all(self):
+        self.cropped_faces = []
+        self.restored_faces = []
+
+    def add_restored_face(self, restored_face):
+        self.restored_faces.append(restored_face)
+
+
+def save_checkpoint(tmp_path, monkeypatch):
+    """Save a random 64x64 GFPGANv1Clean checkpoint, and use aligned face helpers."""
+    torch.manual_seed(0)
+    net = GFPGANv1Clean(
+        out_size=64, num_style_feat=512, channel_multiplier=1, num_mlp=8, input_is_latent=True, different_w=True,
+        sft_half=True)
+    model_path = str(tmp_path / 'gfpgan_64.pth')
+    torch.save({'params_ema': net.state_dict()}, model_path)
+    monkeypatch.setattr(gfpgan.utils, 'acquire_face_helper',
+                        lambda *args, **kwargs: (AlignedFaceHelper(), 'backend', threading.Lock()))
+    monkeypatch.setattr(gfpgan.utils, 'release_face_helper', lambda key: None)
+    return model_path
+
+
+def test_enhance_batch_matches_enhance(tmp_path, monkeypatch):
+    """Test GFPGANer: enhance_batch pools the faces of all the images, and matches enhance exactly"""
+    model_path = save_checkpoint(tmp_path, monkeypatch)
+    restorer = GFPGANer(model_path, device=torch.device('cpu'), randomize_noise=False, fixed_batch_size=4)
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 256, (64, 64, 3), dtype=np.uint8) for _ in range(6)]
+
+    results = restorer.enhance_batch(imgs, has_aligned=True, max_batch_size=4)
+    assert len(results) == len(imgs)
+    for img, (_, restored_faces, _) in zip(imgs, results):
+        _, expected_faces, _ = restorer.enhance(img, has_aligned=True)
+        assert len(restored_faces) == 1
+        np.testing.assert_array_equal(restored_faces[0], expected_faces[0])
+
+
+@pytest.mark.parametrize('precision, max_diff_bound, psnr_bound', [('bf16', 4, 49), ('fp16', 1, 60)])
+def test_precision_error_bound(tmp_path, monkeypatch, precision, max_diff_bound, psnr_bound):
+    """Test GFPGANer: the bf16 and fp16 restorations are within the documented bounds of the fp32 ones"""
+    model_path = save_checkpoint(tmp_path, monkeypatch)
+    rng = np.random.default_rng(0)
+    faces = [cv2.GaussianBlur(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8), (0, 0), 1) for _ in range(4)]
+    faces = [cv2.normalize(face, None, 0, 255, cv2.NORM_MINMAX) for face in faces]
+
+    restored_faces = {}
+    for name in ('fp32', precision):
+        restorer = GFPGANer(model_path, device=torch.device('cpu'), precision=name, randomize_noise=False)
+        restored_faces[name] = restorer.restore_faces(faces)
+    for restored_face, reference in zip(restored_faces[precision], restored_faces['fp32']):
+        assert np.abs(restored_face.astype(np.int16) - reference).max() <= max_diff_bound
+        assert calculate_psnr(restored_face, reference, crop_border=0) >= psnr_bound
+
+
+def test_get_or_create(tmp_path, monkeypatch):
+    """Test GFPGANer.get_or_create: cache keys, and the release of the evicted restorers"""
+    model_path = save_checkpoint(tmp_path, monkeypatch)
+    released = []
+    monkeypatch.setattr(gfpgan.utils, 'release_face_helper', released.append)
+    GFPGANer.clear_cache()
+    released.clear()
+
+    device = torch.device('cpu')
+    bg_upsampler = object()
+    # list options are keyed as tuples, the bg_upsampler by identity
+    restorer = GFPGANer.get_or_create(model_path, bg_upsampler=bg_upsampler, device=device, compile_batch_sizes=[1, 2])
+    assert GFPGANer.get_or_create(
+        model_path, bg_upsampler=bg_upsampler, device=device, compile_batch_sizes=[1, 2]) is restorer
+    other_restorer = GFPGANer.get_or_create(
+        model_path, bg_upsampler=object(), device=device, compile_batch_sizes=[1, 2])
+    assert other_restorer is not restorer
+
+    # the evicted restorers release their face helpers, the most recently used one is kept
+    monkeypatch.setattr(GFPGANer, 'cache_memory_budget', 0)
+    last_restorer = GFPGANer.get_or_create(model_path, upscale=4, device=device)
+    assert released == ['backend', 'backend']
+    assert list(GFPGANer._cache.values()) == [last_restorer]
+    GFPGANer.clear_cache()
+    assert released == ['backend'] * 3